@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import os
+import pathlib
+from collections import OrderedDict
+
+import aiohttp
+
+AUDIO_FILE_SUFFIX = ".audio"
+PARTIAL_FILE_SUFFIX = ".part"
+# googlevideo throttles un-ranged downloads, so audio is fetched in ranged chunks like pytube does.
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+logger = logging.getLogger("discord")
+
+
+class AudioCache:
+
+    def __init__(self, directory: pathlib.Path, max_bytes: int, max_concurrent_downloads: int = 2):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # A single track may use at most this share of the budget so one long mix cannot flush the whole cache.
+        self.max_file_bytes = max_bytes // 8
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._total_bytes = 0
+        self._downloads: dict[str, asyncio.Task] = {}
+        self._download_slots = asyncio.Semaphore(max_concurrent_downloads)
+        self._session: aiohttp.ClientSession | None = None
+        self._load_index()
+
+    @classmethod
+    def from_environment(cls) -> "AudioCache | None":
+        if not os.getenv("AUDIO_CACHE_DIR"):
+            return None
+        max_bytes = int(os.getenv("AUDIO_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+        return cls(pathlib.Path(os.environ["AUDIO_CACHE_DIR"]), max_bytes)
+
+    def _load_index(self):
+        for partial_file in self.directory.glob(f"*{PARTIAL_FILE_SUFFIX}"):
+            partial_file.unlink(missing_ok=True)
+        audio_files = sorted(self.directory.glob(f"*{AUDIO_FILE_SUFFIX}"), key=lambda path: path.stat().st_mtime)
+        for audio_file in audio_files:
+            size = audio_file.stat().st_size
+            self._entries[audio_file.stem] = size
+            self._total_bytes += size
+        self._evict()
+
+    def __contains__(self, video_id: str):
+        return video_id in self._entries
+
+    def _path_for(self, video_id: str, suffix: str = AUDIO_FILE_SUFFIX) -> pathlib.Path:
+        return self.directory / f"{video_id}{suffix}"
+
+    def get_path(self, video_id: str) -> pathlib.Path | None:
+        if video_id not in self._entries:
+            return None
+        path = self._path_for(video_id)
+        if not path.exists():
+            self._total_bytes -= self._entries.pop(video_id)
+            return None
+        self._entries.move_to_end(video_id)
+        # The mtime doubles as the persisted LRU order for the next startup.
+        os.utime(path)
+        return path
+
+    def store_in_background(self, video_id: str, url: str):
+        if video_id in self._entries or video_id in self._downloads:
+            return
+        task = asyncio.create_task(self._store(video_id, url))
+        self._downloads[video_id] = task
+        task.add_done_callback(lambda _: self._downloads.pop(video_id, None))
+
+    async def _store(self, video_id: str, url: str):
+        partial_path = self._path_for(video_id, PARTIAL_FILE_SUFFIX)
+        try:
+            async with self._download_slots:
+                size = await self._download(url, partial_path)
+        except Exception:
+            logger.warning(f"Failed to cache audio for {video_id}", exc_info=True)
+            partial_path.unlink(missing_ok=True)
+            return
+        if size is None:
+            partial_path.unlink(missing_ok=True)
+            return
+        partial_path.replace(self._path_for(video_id))
+        self._entries[video_id] = size
+        self._total_bytes += size
+        self._evict()
+        logger.debug(f"Cached {size} bytes of audio for {video_id}, cache now holds {self._total_bytes} bytes")
+
+    async def _download(self, url: str, partial_path: pathlib.Path) -> int | None:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        loop = asyncio.get_running_loop()
+        downloaded = 0
+        with open(partial_path, "wb") as partial_file:
+            while True:
+                chunk_url = f"{url}&range={downloaded}-{downloaded + DOWNLOAD_CHUNK_SIZE - 1}"
+                async with self._session.get(chunk_url) as response:
+                    response.raise_for_status()
+                    chunk = await response.read()
+                await loop.run_in_executor(None, partial_file.write, chunk)
+                downloaded += len(chunk)
+                if downloaded > self.max_file_bytes:
+                    return None
+                if len(chunk) < DOWNLOAD_CHUNK_SIZE:
+                    return downloaded
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._entries:
+            video_id, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self._path_for(video_id).unlink(missing_ok=True)
+
+    async def close(self):
+        for task in list(self._downloads.values()):
+            task.cancel()
+        if self._session is not None:
+            await self._session.close()
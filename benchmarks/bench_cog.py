@@ -0,0 +1,106 @@
+import argparse
+import asyncio
+import pathlib
+import tempfile
+
+import database
+from benchmarks.fakes import ApiCallCounter, FakeBot, FakeContext, FakeGuild, FakeInteraction, FakeMember, \
+    FakeMessage, FakeReaction, FakeTextChannel, FakeVoiceChannel, fake_youtube
+from benchmarks.stats import measure
+from discord_bot import YouTubePlayer
+from outbound import OutboundScheduler, DELETE_BATCH_DELAY
+from stream_cache import StreamCache
+
+DRAIN_DELAY = DELETE_BATCH_DELAY + 5
+
+class CogHarness:
+
+    def __init__(self):
+        self.api_calls = ApiCallCounter()
+        self.bot = FakeBot()
+        self.guild = FakeGuild()
+        self.text_channel = FakeTextChannel(self.guild, self.api_calls)
+        self.bot.channels[self.text_channel.id] = self.text_channel
+        self.voice_channel = FakeVoiceChannel(self.guild)
+        self.member = FakeMember(self.guild, "listener", voice_channel=self.voice_channel)
+        self.cog = YouTubePlayer(self.bot)
+        # The stand-in channel has no rate limit, so the outbox is left unthrottled to time the cog itself.
+        self.cog.outbound = OutboundScheduler(window=0)
+        # The stand-in resolver is a local function, which cannot be sent to a worker process.
+        self.cog.stream_cache.close()
+        self.cog.stream_cache = StreamCache(use_processes=False)
+
+    async def __aenter__(self) -> "CogHarness":
+        await self.cog.cog_load()
+        self.cog.guild_text_channel_ids[self.guild.id] = self.text_channel.id
+        return self
+
+    async def __aexit__(self, *_exc_info):
+        await self.cog.cog_unload()
+
+    def context(self, content: str) -> FakeContext:
+        return FakeContext(FakeMessage(self.text_channel, self.member, content))
+
+    async def invoke(self, command_name: str, *args):
+        # The cog is never injected into a real Bot, so command callbacks are called with the cog bound explicitly.
+        command = self.cog.get_commands()[[command.name for command in self.cog.get_commands()].index(command_name)]
+        await command.callback(self.cog, self.context(f"!{command_name}"), *args)
+
+    async def search(self, query: str) -> FakeMessage:
+        await self.cog.search_yt(self.context(query), query)
+        return next(message for message in reversed(self.text_channel.messages) if message.view)
+
+    async def select(self, menu_message: FakeMessage, index: int = 0):
+        await FakeInteraction(self.member, menu_message).click(index)
+
+    async def react(self, menu_message: FakeMessage, emoji: str = "1️⃣"):
+        await self.cog.on_reaction_add(FakeReaction(emoji, menu_message), self.member)
+
+
+async def run_benchmarks(iterations: int, search_latency: float, resolve_latency: float, queue_length: int):
+    with fake_youtube(search_latency=search_latency, resolve_latency=resolve_latency):
+        async with CogHarness() as harness:
+            await measure("search_yt (cache miss)",
+                          lambda iteration: harness.search(f"unique query {iteration}"), iterations)
+            await measure("search_yt (cache hit)",
+                          lambda _: harness.search("popular song"), iterations)
+            menus = [await harness.search(f"selection {iteration}") for iteration in range(iterations)]
+            await measure("search menu button",
+                          lambda iteration: harness.select(menus[iteration]), iterations)
+            menus = [await harness.search(f"reaction {iteration}") for iteration in range(iterations)]
+            await measure("on_reaction_add (search selection)",
+                          lambda iteration: harness.react(menus[iteration]), iterations)
+            await measure("on_reaction_add (unrelated message)",
+                          lambda _: harness.react(harness.context("chatter").message), iterations)
+
+            state = harness.cog.guild_states.get(harness.guild.id)
+            while len(state.queue) < queue_length:
+                await harness.select(await harness.search(f"filler {len(state.queue)}"))
+            await measure(f"queue ({len(state.queue)} queued)",
+                          lambda _: harness.invoke("queue"), iterations)
+            await measure("history (page 1)",
+                          lambda _: harness.invoke("history"), iterations)
+            await measure("top",
+                          lambda _: harness.invoke("top"), iterations)
+            await measure("skip",
+                          lambda _: harness.invoke("skip"), min(iterations, len(state.queue)))
+            await asyncio.sleep(DRAIN_DELAY)
+            print(f"\nDiscord API calls: {harness.api_calls.total} {harness.api_calls.calls}")
+            print(f"Search cache: {harness.cog.search_cache.hits} hits, {harness.cog.search_cache.misses} misses")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Drive YouTubePlayer commands against local stand-ins")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--search-latency", type=float, default=0.0)
+    parser.add_argument("--resolve-latency", type=float, default=0.0)
+    parser.add_argument("--queue-length", type=int, default=1000)
+    arguments = parser.parse_args()
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        database.DATABASE_PATH = str(pathlib.Path(temporary_directory) / "history.db")
+        await run_benchmarks(arguments.iterations, arguments.search_latency, arguments.resolve_latency,
+                             arguments.queue_length)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
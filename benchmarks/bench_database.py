@@ -0,0 +1,101 @@
+import argparse
+import asyncio
+import pathlib
+import random
+import sqlite3
+import tempfile
+import time
+
+import database
+from benchmarks.stats import BenchmarkResult, measure
+from data_classes import YoutubeSearchResult
+
+BENCHMARK_GUILD_ID = 1
+
+
+def populate_history(database_path: pathlib.Path, row_count: int):
+    # Rows are spread over the retention window so paging and the retention batches see realistic timestamps. They
+    # all belong to one guild, the worst case for that guild's paging and search.
+    now = time.time()
+    retention_seconds = database.HISTORY_RETENTION_DAYS * 24 * 60 * 60 * 0.9
+    connection = sqlite3.connect(database_path)
+    with connection:
+        connection.executemany(
+            f"INSERT INTO {database.HISTORY_TABLE_NAME} "
+            f"(GUILD_ID, SEARCH_ID, ADDED_BY, TITLE, UPLOADER_NAME, WATCH_URL, ADDED_AT) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((BENCHMARK_GUILD_ID, f"search-{index}", f"user-{index % 50}", f"Track {index}", f"Channel {index % 500}",
+              f"https://youtube.com/watch?v={index:011d}", now - retention_seconds * index / row_count)
+             for index in range(row_count))
+        )
+    connection.close()
+
+
+def make_search_result(index: int) -> YoutubeSearchResult:
+    return YoutubeSearchResult(
+        uuid=f"search-{index}",
+        added_by="benchmark",
+        uploader_name="Benchmark Channel",
+        title=f"Track {index}",
+        url=None,
+        watch_url=f"https://youtube.com/watch?v={index:011d}"
+    )
+
+
+async def measure_paging_between_plays(row_count: int, iterations: int, randomizer: random.Random):
+    # Follows next-page cursors the way the history menu does, with a track played before every page so the
+    # writes the bot makes during paging are part of the picture. Only the page reads are timed.
+    result = BenchmarkResult("get_recent_history_items (next page, plays between)")
+    cursor = None
+    for _ in range(iterations):
+        await database.insert_playlist_item_to_history_db(BENCHMARK_GUILD_ID,
+                                                          make_search_result(randomizer.randrange(row_count)))
+        started_at = time.perf_counter()
+        _, _, cursor = await database.get_recent_history_items(BENCHMARK_GUILD_ID, 1, cursor)
+        result.samples.append(time.perf_counter() - started_at)
+    print(result)
+
+
+async def benchmark_history_size(row_count: int, iterations: int):
+    print(f"\n== YOUTUBE_BOT_HISTORY with {row_count} rows ==")
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        database.DATABASE_PATH = str(pathlib.Path(temporary_directory) / "history.db")
+        await database.initialize_database()
+        await database.close_database()
+        populate_history(pathlib.Path(database.DATABASE_PATH), row_count)
+        total_pages = -(-row_count // database.HISTORY_PAGE_SIZE)
+        randomizer = random.Random(row_count)
+
+        await measure("insert_playlist_item_to_history_db (replay)",
+                      lambda _: database.insert_playlist_item_to_history_db(
+                          BENCHMARK_GUILD_ID, make_search_result(randomizer.randrange(row_count))), iterations)
+        await measure("insert_playlist_item_to_history_db (new track)",
+                      lambda iteration: database.insert_playlist_item_to_history_db(
+                          BENCHMARK_GUILD_ID, make_search_result(row_count + iteration)), iterations)
+        await measure("get_recent_history_items (page 1)",
+                      lambda _: database.get_recent_history_items(BENCHMARK_GUILD_ID, 1), iterations)
+        await measure_paging_between_plays(row_count, iterations, randomizer)
+        await measure("get_recent_history_items (random page)",
+                      lambda _: database.get_recent_history_items(BENCHMARK_GUILD_ID,
+                                                                  randomizer.randrange(total_pages) + 1),
+                      max(1, iterations // 10))
+        await measure("get_search_result_for_search_id",
+                      lambda _: database.get_search_result_for_search_id(
+                          f"search-{randomizer.randrange(row_count)}"), iterations)
+        # Runs last since it removes rows: each call deletes the next batch from the older half of the table.
+        cutoff = time.time() - database.HISTORY_RETENTION_DAYS * 24 * 60 * 60 * 0.45
+        await measure("delete_expired_history (batch)",
+                      lambda _: database.delete_expired_history(cutoff), max(1, iterations // 100))
+        await database.close_database()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Time database.py against synthetic history tables")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--iterations", type=int, default=1000)
+    arguments = parser.parse_args()
+    for row_count in arguments.rows:
+        await benchmark_history_size(row_count, arguments.iterations)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
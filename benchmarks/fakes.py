@@ -0,0 +1,357 @@
+import asyncio
+import contextlib
+import itertools
+import time
+from dataclasses import dataclass, field
+from unittest import mock
+
+import discord
+
+import playlist_ingest
+import search_cache
+import stream_cache
+from stream_cache import ResolvedStream
+
+_ids = itertools.count(1_000_000)
+
+
+def next_id() -> int:
+    return next(_ids)
+
+
+@dataclass
+class ApiCallCounter:
+    calls: dict[str, int] = field(default_factory=dict)
+
+    def record(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.calls.values())
+
+
+class FakeGuild:
+
+    def __init__(self, guild_id: int | None = None):
+        self.id = guild_id or next_id()
+        self.me = FakeMember(self, "youtube-bot", bot=True)
+        # Set when the guild is driven through a FakeGateway, which then dispatches the bot's own voice state updates.
+        self.gateway: "FakeGateway | None" = None
+
+
+class FakeMessage:
+
+    def __init__(self, channel: "FakeTextChannel", author: "FakeMember", content: str,
+                 view: discord.ui.View | None = None):
+        self.id = next_id()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.view = view
+        self.reactions: list[str] = []
+
+    @property
+    def clean_content(self) -> str:
+        return self.content
+
+    async def add_reaction(self, emoji: str):
+        self.channel.api_calls.record("add_reaction")
+        self.reactions.append(emoji)
+
+    async def delete(self, delay: float | None = None):
+        self.channel.api_calls.record("delete_message")
+
+    async def edit(self, content: str | None = None, view: discord.ui.View | None = None, **_kwargs):
+        self.channel.api_calls.record("edit_message")
+        if content is not None:
+            self.content = content
+        if view is not None:
+            self.view = view
+
+
+class FakeTextChannel:
+
+    def __init__(self, guild: FakeGuild, api_calls: ApiCallCounter, name: str = "youtube-music-bot"):
+        self.id = next_id()
+        self.guild = guild
+        self.name = name
+        self.api_calls = api_calls
+        self.messages: list[FakeMessage] = []
+
+    async def send(self, content: str | None = None, view: discord.ui.View | None = None, **_kwargs) -> FakeMessage:
+        self.api_calls.record("send_message")
+        message = FakeMessage(self, self.guild.me, content or "", view)
+        self.messages.append(message)
+        return message
+
+    async def delete_messages(self, messages: list[FakeMessage]):
+        self.api_calls.record("bulk_delete_messages")
+
+    async def purge(self, limit: int = 100):
+        self.api_calls.record("purge")
+        del self.messages[-limit:]
+
+
+class FakeAudioSource:
+
+    def __init__(self, source: str, **_kwargs):
+        self.source = source
+
+    @classmethod
+    async def from_probe(cls, source: str, **kwargs) -> "FakeAudioSource":
+        return cls(source, **kwargs)
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+
+    def __init__(self, channel: "FakeVoiceChannel"):
+        self.channel = channel
+        self.connected = True
+        self.source: FakeAudioSource | None = None
+        self.started_at: list[float] = []
+        self._after = None
+        self._finish_timer: asyncio.TimerHandle | None = None
+
+    def is_connected(self) -> bool:
+        return self.connected
+
+    def play(self, source: FakeAudioSource, after=None):
+        self.source = source
+        self.started_at.append(time.perf_counter())
+        self.channel.playback_log.append((self.started_at[-1], source.source))
+        self._after = after
+        if self.channel.track_duration is not None:
+            self._finish_timer = asyncio.get_running_loop().call_later(self.channel.track_duration, self.stop)
+
+    def stop(self):
+        # discord.py calls `after` from its player thread once the source stops.
+        if self._finish_timer:
+            self._finish_timer.cancel()
+            self._finish_timer = None
+        after, self._after = self._after, None
+        self.source = None
+        if after:
+            after(None)
+
+    def detach(self):
+        # Drops the playing source without calling `after`, as when the bot process exits mid-track.
+        if self._finish_timer:
+            self._finish_timer.cancel()
+            self._finish_timer = None
+        self._after = None
+
+    async def move_to(self, channel: "FakeVoiceChannel"):
+        previous_channel, self.channel = self.channel, channel
+        move_member(self.channel.guild.me, previous_channel, channel)
+
+    async def disconnect(self, force: bool = False):
+        self.connected = False
+        self.stop()
+        move_member(self.channel.guild.me, self.channel, None)
+
+
+class FakeVoiceChannel:
+
+    def __init__(self, guild: FakeGuild, track_duration: float | None = None):
+        self.id = next_id()
+        self.guild = guild
+        self.members: list[FakeMember] = []
+        self.voice_client: FakeVoiceClient | None = None
+        self.bitrate = 64000
+        # With a duration set, every played source ends on its own after that long, as a real track would.
+        self.track_duration = track_duration
+        self.playback_log: list[tuple[float, str]] = []
+
+    async def connect(self) -> FakeVoiceClient:
+        self.voice_client = FakeVoiceClient(self)
+        move_member(self.guild.me, None, self)
+        return self.voice_client
+
+
+@dataclass
+class FakeVoiceState:
+    channel: FakeVoiceChannel | None
+
+
+class FakeMember:
+
+    def __init__(self, guild: FakeGuild, name: str, bot: bool = False, voice_channel: FakeVoiceChannel | None = None):
+        self.id = next_id()
+        self.guild = guild
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.voice = FakeVoiceState(voice_channel) if voice_channel else None
+        if voice_channel:
+            voice_channel.members.append(self)
+
+
+def move_member(member: FakeMember, before: FakeVoiceChannel | None, after: FakeVoiceChannel | None):
+    if before is not None and member in before.members:
+        before.members.remove(member)
+    if after is not None:
+        after.members.append(member)
+    member.voice = FakeVoiceState(after) if after else None
+    if member.guild.gateway:
+        member.guild.gateway.dispatch_voice_state_update(member, FakeVoiceState(before), FakeVoiceState(after))
+
+
+class FakeContext:
+
+    def __init__(self, message: FakeMessage):
+        self.message = message
+        self.author = message.author
+        self.channel = message.channel
+        self.guild = message.guild
+
+    @property
+    def voice_client(self) -> FakeVoiceClient | None:
+        return self.author.voice.channel.voice_client if self.author.voice else None
+
+    async def send(self, content: str | None = None, **kwargs) -> FakeMessage:
+        return await self.channel.send(content, **kwargs)
+
+
+@dataclass
+class FakeReaction:
+    emoji: str
+    message: FakeMessage
+
+
+class FakeInteractionResponse:
+
+    def __init__(self, api_calls: ApiCallCounter):
+        self.api_calls = api_calls
+
+    async def defer(self):
+        self.api_calls.record("interaction_response")
+
+    async def send_message(self, _content: str, **_kwargs):
+        self.api_calls.record("interaction_response")
+
+
+class FakeInteraction:
+
+    def __init__(self, user: FakeMember, message: FakeMessage):
+        self.user = user
+        self.message = message
+        self.response = FakeInteractionResponse(message.channel.api_calls)
+
+    async def click(self, index: int):
+        # Mirrors discord.py's dispatch: the view's interaction_check runs before the button callback.
+        if await self.message.view.interaction_check(self):
+            await self.message.view.children[index].callback(self)
+
+
+class FakeBot:
+
+    def __init__(self):
+        self.channels: dict[int, FakeTextChannel] = {}
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return asyncio.get_running_loop()
+
+    @property
+    def voice_clients(self) -> list[FakeVoiceClient]:
+        return []
+
+    async def wait_until_ready(self):
+        pass
+
+    def get_channel(self, channel_id: int) -> FakeTextChannel | None:
+        return self.channels.get(channel_id)
+
+    async def get_context(self, message: FakeMessage) -> FakeContext:
+        return FakeContext(message)
+
+
+class FakeYouTube:
+
+    def __init__(self, video_index: int):
+        self.video_id = f"{video_index:011d}"
+        self.watch_url = f"https://youtube.com/watch?v={self.video_id}"
+        self.title = f"Track {video_index}"
+        self.author = f"Channel {video_index % 100}"
+        self.age_restricted = False
+
+
+class FakeGateway:
+    # Delivers events to a loaded cog the way discord.py's gateway would: each event runs as its own task, commands
+    # are dispatched alongside the on_message listener, and voice state changes reach on_voice_state_update.
+
+    def __init__(self, cog, bot: FakeBot):
+        self.cog = cog
+        self.bot = bot
+        self.commands = {name: command for command in cog.get_commands()
+                         for name in (command.name, *command.aliases)}
+        self.tasks: set[asyncio.Task] = set()
+
+    def dispatch(self, coroutine) -> asyncio.Task:
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def send_message(self, member: FakeMember, channel: FakeTextChannel, content: str):
+        message = FakeMessage(channel, member, content)
+        handlers = [self.cog.on_message(message)]
+        if content.startswith("!"):
+            command_name, *args = content[1:].split()
+            command = self.commands.get(command_name)
+            if command is not None:
+                # The cog is never injected into a real Bot, so command callbacks are called with the cog bound.
+                handlers.append(command.callback(self.cog, await self.bot.get_context(message), *args))
+        await asyncio.gather(*handlers)
+
+    async def add_reaction(self, member: FakeMember, message: FakeMessage, emoji: str):
+        await self.cog.on_reaction_add(FakeReaction(emoji, message), member)
+
+    async def click(self, member: FakeMember, message: FakeMessage, index: int):
+        await FakeInteraction(member, message).click(index)
+
+    def dispatch_voice_state_update(self, member: FakeMember, before: FakeVoiceState, after: FakeVoiceState):
+        self.dispatch(self.cog.on_voice_state_update(member, before, after))
+
+    async def drain(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
+@contextlib.contextmanager
+def fake_youtube(search_latency: float = 0.0, resolve_latency: float = 0.0, playlist_size: int = 50,
+                 track_duration: float | None = None):
+    # Replaces every pytube call the cog makes with local stand-ins that sleep for the given latency.
+    video_indexes = itertools.count()
+
+    def fetch_top_results(_search_input: str) -> list[FakeYouTube]:
+        time.sleep(search_latency)
+        return [FakeYouTube(next(video_indexes)) for _ in range(search_cache.SEARCH_RESULT_LIMIT)]
+
+    def resolve_streams(watch_url: str) -> list[ResolvedStream]:
+        time.sleep(resolve_latency)
+        url = f"https://googlevideo.invalid/videoplayback?id={stream_cache.get_video_id(watch_url)}&expire=" \
+              f"{int(time.time()) + 6 * 60 * 60}"
+        return [ResolvedStream(url=url, expires_at=stream_cache.get_stream_url_expiry(url), mime_type="audio/webm",
+                               audio_codec="opus", duration=track_duration, bitrate_kbps=160)]
+
+    def fetch_track_metadata(watch_url: str) -> tuple[str, str]:
+        time.sleep(resolve_latency)
+        return f"Playlist track {stream_cache.get_video_id(watch_url)}", "Playlist channel"
+
+    class FakePlaylist:
+
+        def __init__(self, _playlist_url: str):
+            self.video_urls = (FakeYouTube(next(video_indexes)).watch_url for _ in range(playlist_size))
+
+    with mock.patch.object(search_cache, "fetch_top_results", fetch_top_results), \
+            mock.patch.object(stream_cache, "resolve_streams", resolve_streams), \
+            mock.patch.object(playlist_ingest, "fetch_track_metadata", fetch_track_metadata), \
+            mock.patch.object(playlist_ingest, "Playlist", FakePlaylist), \
+            mock.patch.object(discord, "FFmpegOpusAudio", FakeAudioSource):
+        yield
@@ -0,0 +1,317 @@
+import argparse
+import asyncio
+import dataclasses
+import json
+import pathlib
+import random
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from unittest import mock
+
+import database
+import track_queue
+from benchmarks.fakes import ApiCallCounter, FakeBot, FakeGateway, FakeGuild, FakeMember, FakeMessage, \
+    FakeTextChannel, FakeVoiceChannel, fake_youtube, move_member
+from benchmarks.stats import BenchmarkResult
+from discord_bot import YouTubePlayer, SEARCH_MENU_TIMEOUT
+from menus import HistoryMenu, NUMBER_EMOJIS, SearchMenu
+from stream_cache import StreamCache, get_video_id
+from voice_presence import VoicePresenceTracker
+
+LAG_SAMPLE_INTERVAL = 0.01
+SETTLE_DELAY = 0.5
+MENU_POLL_INTERVAL = 0.05
+
+
+@dataclass
+class TraceEvent:
+    # `at` is seconds from the start of the trace. Kinds:
+    #   message - `user` sends `content` to the bot's text channel (searches, playlist links and !commands)
+    #   click   - `user` presses button `index` on the next menu they can use, waiting for it to be shown
+    #   react   - the same, through a number reaction
+    #   join    - `user` joins the voice channel numbered `channel`
+    #   leave   - `user` leaves voice
+    at: float
+    kind: str
+    user: str
+    content: str = ""
+    index: int = 0
+    channel: int = 0
+
+
+def search_burst(randomizer: random.Random, users: int) -> list[TraceEvent]:
+    # Everyone joins, then searches and picks a result within the same couple of seconds.
+    events = [TraceEvent(randomizer.uniform(0, 0.5), "join", f"user-{user}") for user in range(users)]
+    for user in range(users):
+        searched_at = randomizer.uniform(1, 2)
+        events.append(TraceEvent(searched_at, "message", f"user-{user}", f"song number {randomizer.randrange(1000)}"))
+        events.append(TraceEvent(searched_at + randomizer.uniform(1, 2), randomizer.choice(["click", "react"]),
+                                 f"user-{user}", index=randomizer.randrange(3)))
+    return events
+
+
+def skip_storm(randomizer: random.Random, users: int) -> list[TraceEvent]:
+    # A queue is built up, then skips and queue listings arrive faster than tracks can start.
+    events = search_burst(randomizer, users)
+    for _ in range(users * 3):
+        command = randomizer.choice(["!skip", "!s 2", "!queue", "!q"])
+        events.append(TraceEvent(randomizer.uniform(5, 8), "message", f"user-{randomizer.randrange(users)}", command))
+    return events
+
+
+def voice_churn(randomizer: random.Random, users: int) -> list[TraceEvent]:
+    # Listeners hop between channels and leave while playback continues, until the last one is gone.
+    events = search_burst(randomizer, users)
+    for user in range(users):
+        hopped_at = randomizer.uniform(4, 7)
+        events.append(TraceEvent(hopped_at, "join", f"user-{user}", channel=1))
+        events.append(TraceEvent(hopped_at + randomizer.uniform(0.5, 1), "join", f"user-{user}", channel=0))
+        events.append(TraceEvent(randomizer.uniform(8, 10), "leave", f"user-{user}"))
+    return events
+
+
+def mixed(randomizer: random.Random, users: int) -> list[TraceEvent]:
+    # Steady traffic over twenty seconds: searches with selections, history and stats commands, skips.
+    events = [TraceEvent(randomizer.uniform(0, 0.5), "join", f"user-{user}") for user in range(users)]
+    for _ in range(users * 4):
+        user = f"user-{randomizer.randrange(users)}"
+        at = randomizer.uniform(1, 20)
+        action = randomizer.choices(["search", "history", "command"], weights=[6, 1, 3])[0]
+        if action == "search":
+            events.append(TraceEvent(at, "message", user, f"artist {randomizer.randrange(50)}"))
+            events.append(TraceEvent(at + randomizer.uniform(0.5, 3), "click", user, index=randomizer.randrange(3)))
+        elif action == "history":
+            events.append(TraceEvent(at, "message", user, randomizer.choice(["!history", "!find artist"])))
+            events.append(TraceEvent(at + randomizer.uniform(0.5, 2), "click", user))
+        else:
+            events.append(TraceEvent(at, "message", user, randomizer.choice(["!queue", "!skip", "!top", "!top me"])))
+    return events
+
+
+SCENARIOS = {
+    "search_burst": search_burst,
+    "skip_storm": skip_storm,
+    "voice_churn": voice_churn,
+    "mixed": mixed,
+}
+
+
+def load_trace(trace_path: pathlib.Path) -> list[TraceEvent]:
+    with open(trace_path, encoding="utf-8") as trace_file:
+        return [TraceEvent(**json.loads(line)) for line in trace_file if line.strip()]
+
+
+def save_trace(trace_path: pathlib.Path, events: list[TraceEvent]):
+    with open(trace_path, "w", encoding="utf-8") as trace_file:
+        trace_file.writelines(json.dumps(dataclasses.asdict(event)) + "\n" for event in events)
+
+
+class Simulation:
+    # One guild with a bound text channel and two voice channels, driven through a FakeGateway. Everything the cog
+    # talks to is a local stand-in, so a trace replays the same event sequence on every run.
+
+    def __init__(self, arguments: argparse.Namespace):
+        self.arguments = arguments
+        self.api_calls = ApiCallCounter()
+        self.bot = FakeBot()
+        self.guild = FakeGuild()
+        self.text_channel = FakeTextChannel(self.guild, self.api_calls)
+        self.bot.channels[self.text_channel.id] = self.text_channel
+        self.voice_channels = [FakeVoiceChannel(self.guild, arguments.track_duration) for _ in range(2)]
+        self.members: dict[str, FakeMember] = {}
+        self.used_menus: set[tuple[str, int]] = set()
+        self.cog = YouTubePlayer(self.bot)
+        # The stand-in resolver is a local function, which cannot be sent to a worker process.
+        self.cog.stream_cache.close()
+        self.cog.stream_cache = StreamCache(use_processes=False)
+        self.cog.voice_presence = VoicePresenceTracker(grace_period=arguments.voice_grace_period,
+                                                       on_empty=self.cog.on_voice_channel_empty)
+        self.gateway = FakeGateway(self.cog, self.bot)
+        self.guild.gateway = self.gateway
+        self.latencies: dict[str, BenchmarkResult] = {}
+        self.loop_lag = BenchmarkResult("event loop lag")
+        self.queued_at: dict[str, list[tuple[float, bool]]] = defaultdict(list)
+        self.failed_events = 0
+        self.missed_menus = 0
+
+    def member(self, name: str) -> FakeMember:
+        if name not in self.members:
+            self.members[name] = FakeMember(self.guild, name)
+        return self.members[name]
+
+    def newest_menu_message(self, member: FakeMember) -> FakeMessage | None:
+        for message in reversed(self.text_channel.messages):
+            menu = self.cog.pending_menus.get(message.id)
+            if not message.view or not message.view.children or (member.name, message.id) in self.used_menus:
+                continue
+            if isinstance(menu, HistoryMenu) or isinstance(menu, SearchMenu) and menu.requester_id == member.id:
+                return message
+        return None
+
+    async def wait_for_menu(self, member: FakeMember) -> FakeMessage | None:
+        # A user can only pick from a menu once it is shown, so the selection waits for it like they would.
+        deadline = time.perf_counter() + SEARCH_MENU_TIMEOUT
+        while time.perf_counter() < deadline:
+            menu_message = self.newest_menu_message(member)
+            if menu_message is not None:
+                self.used_menus.add((member.name, menu_message.id))
+                return menu_message
+            await asyncio.sleep(MENU_POLL_INTERVAL)
+        return None
+
+    async def handle(self, event: TraceEvent, menu_message: FakeMessage | None = None):
+        member = self.member(event.user)
+        if event.kind == "message":
+            await self.gateway.send_message(member, self.text_channel, event.content)
+        elif event.kind == "click":
+            await self.gateway.click(member, menu_message, min(event.index, len(menu_message.view.children) - 1))
+        elif event.kind == "react":
+            await self.gateway.add_reaction(member, menu_message, NUMBER_EMOJIS[event.index])
+        elif event.kind == "join":
+            before = member.voice.channel if member.voice else None
+            move_member(member, before, self.voice_channels[event.channel])
+        elif event.kind == "leave" and member.voice:
+            move_member(member, member.voice.channel, None)
+
+    def label(self, event: TraceEvent) -> str:
+        if event.kind != "message":
+            return event.kind
+        if not event.content.startswith("!"):
+            return "search"
+        command = self.gateway.commands.get(event.content[1:].split()[0])
+        return f"command !{command.name}" if command else "unknown command"
+
+    async def timed_handle(self, event: TraceEvent):
+        label = self.label(event)
+        menu_message = None
+        if event.kind in ("click", "react"):
+            # Waiting for the menu to be shown is not counted; the selection itself is timed from when it is made.
+            menu_message = await self.wait_for_menu(self.member(event.user))
+            if menu_message is None:
+                self.missed_menus += 1
+                return
+        started_at = time.perf_counter()
+        try:
+            await self.handle(event, menu_message)
+        except Exception as exception:
+            self.failed_events += 1
+            print(f"  {label} by {event.user} at {event.at:.2f}s failed: {exception!r}")
+            return
+        self.latencies.setdefault(label, BenchmarkResult(label)).samples.append(time.perf_counter() - started_at)
+
+    async def sample_loop_lag(self):
+        while True:
+            expected_at = time.perf_counter() + LAG_SAMPLE_INTERVAL
+            await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+            self.loop_lag.samples.append(max(0.0, time.perf_counter() - expected_at))
+
+    def record_queued(self, track_queue_append):
+        def append(queue: track_queue.TrackQueue, result):
+            idle = queue.current is None and not queue
+            self.queued_at[get_video_id(result.watch_url)].append((time.perf_counter(), idle))
+            return track_queue_append(queue, result)
+        return append
+
+    async def replay(self, events: list[TraceEvent]):
+        loop = asyncio.get_running_loop()
+        lag_sampler = asyncio.create_task(self.sample_loop_lag())
+        started_at = loop.time()
+        with mock.patch.object(track_queue.TrackQueue, "append", self.record_queued(track_queue.TrackQueue.append)):
+            for event in sorted(events, key=lambda trace_event: trace_event.at):
+                delay = started_at + event.at / self.arguments.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                self.gateway.dispatch(self.timed_handle(event))
+            await self.gateway.drain()
+            # Queued tracks keep playing after the last event; give them time to start so queue-to-audio covers them.
+            deadline = loop.time() + self.arguments.settle_timeout
+            while loop.time() < deadline and any(state.is_playing and state.queue
+                                                 for state in self.cog.guild_states.values()):
+                await asyncio.sleep(SETTLE_DELAY)
+            await self.gateway.drain()
+        lag_sampler.cancel()
+
+    def queue_to_audio(self) -> tuple[BenchmarkResult, BenchmarkResult, int]:
+        idle_player = BenchmarkResult("queue-to-audio (idle player)")
+        queued_behind = BenchmarkResult("queue-to-audio (queued behind)")
+        started_at = defaultdict(list)
+        for voice_channel in self.voice_channels:
+            for played_at, source in voice_channel.playback_log:
+                started_at[source.split("id=")[1].split("&")[0]].append(played_at)
+        never_played = 0
+        for video_id, queued in self.queued_at.items():
+            plays = sorted(started_at.get(video_id, []))
+            for queued_at, idle in queued:
+                played_at = next((played_at for played_at in plays if played_at >= queued_at), None)
+                if played_at is None:
+                    never_played += 1
+                    continue
+                plays.remove(played_at)
+                (idle_player if idle else queued_behind).samples.append(played_at - queued_at)
+        return idle_player, queued_behind, never_played
+
+
+def format_samples(result: BenchmarkResult) -> str:
+    if not result.samples:
+        return f"{result.name:<40} {0:>6}"
+    return f"{result.name:<40} {len(result.samples):>6} p50 {result.percentile(50) * 1000:>9.2f} ms  " \
+           f"p99 {result.percentile(99) * 1000:>9.2f} ms  max {max(result.samples) * 1000:>9.2f} ms"
+
+
+async def run_scenario(name: str, events: list[TraceEvent], arguments: argparse.Namespace):
+    print(f"\n== {name}: {len(events)} events ==")
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        database.DATABASE_PATH = str(pathlib.Path(temporary_directory) / "history.db")
+        with fake_youtube(search_latency=arguments.search_latency, resolve_latency=arguments.resolve_latency,
+                          track_duration=arguments.track_duration):
+            simulation = Simulation(arguments)
+            await simulation.cog.cog_load()
+            simulation.cog.guild_text_channel_ids[simulation.guild.id] = simulation.text_channel.id
+            try:
+                await simulation.replay(events)
+            finally:
+                for voice_channel in simulation.voice_channels:
+                    if voice_channel.voice_client:
+                        voice_channel.voice_client.detach()
+                await simulation.cog.cog_unload()
+    print(format_samples(simulation.loop_lag))
+    for label in sorted(simulation.latencies):
+        print(format_samples(simulation.latencies[label]))
+    idle_player, queued_behind, never_played = simulation.queue_to_audio()
+    print(format_samples(idle_player))
+    print(format_samples(queued_behind))
+    print(f"Tracks still queued at the end: {never_played}, selections without a menu: {simulation.missed_menus}, "
+          f"failed events: {simulation.failed_events}")
+    print(f"Discord API calls: {simulation.api_calls.total} {dict(sorted(simulation.api_calls.calls.items()))}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Replay event traces against YouTubePlayer with local stand-ins")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), nargs="+", default=sorted(SCENARIOS))
+    parser.add_argument("--trace", type=pathlib.Path, help="replay this JSON lines trace instead of the scenarios")
+    parser.add_argument("--save-trace", type=pathlib.Path, help="write the generated traces to DIRECTORY")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--speed", type=float, default=1.0, help="replay the trace this many times faster")
+    parser.add_argument("--search-latency", type=float, default=0.3)
+    parser.add_argument("--resolve-latency", type=float, default=0.2)
+    parser.add_argument("--track-duration", type=float, default=3.0)
+    parser.add_argument("--voice-grace-period", type=float, default=1.0)
+    parser.add_argument("--settle-timeout", type=float, default=30.0,
+                        help="after the last event, wait up to this long for queued tracks to start")
+    arguments = parser.parse_args()
+    if arguments.trace:
+        await run_scenario(arguments.trace.name, load_trace(arguments.trace), arguments)
+        return
+    for name in arguments.scenario:
+        events = SCENARIOS[name](random.Random(arguments.seed), arguments.users)
+        if arguments.save_trace:
+            arguments.save_trace.mkdir(parents=True, exist_ok=True)
+            save_trace(arguments.save_trace / f"{name}.jsonl", events)
+        await run_scenario(name, events, arguments)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
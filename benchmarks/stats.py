@@ -0,0 +1,34 @@
+import statistics
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+
+@dataclass
+class BenchmarkResult:
+    name: str
+    samples: list[float] = field(default_factory=list)
+
+    @property
+    def throughput(self) -> float:
+        total = sum(self.samples)
+        return len(self.samples) / total if total else float("inf")
+
+    def percentile(self, percent: float) -> float:
+        if len(self.samples) < 2:
+            return self.samples[0] if self.samples else 0.0
+        return statistics.quantiles(self.samples, n=100, method="inclusive")[int(percent) - 1]
+
+    def __str__(self):
+        return f"{self.name:<50} {len(self.samples):>7} ops {self.throughput:>12.1f} ops/s " \
+               f"p50 {self.percentile(50) * 1000:>9.3f} ms  p99 {self.percentile(99) * 1000:>9.3f} ms"
+
+
+async def measure(name: str, operation: Callable[[int], Awaitable], iterations: int) -> BenchmarkResult:
+    result = BenchmarkResult(name)
+    for iteration in range(iterations):
+        started_at = time.perf_counter()
+        await operation(iteration)
+        result.samples.append(time.perf_counter() - started_at)
+    print(result)
+    return result
@@ -1,5 +1,4 @@
 import os
-from logging.config import dictConfig
 import pathlib
 
 import discord
@@ -18,7 +17,7 @@ LOGS_DIR = BASE_DIR / "logs"
 
 LOGGING_CONFIG = {
     "version": 1,
-    "disabled_existing_loggers": False,
+    "disable_existing_loggers": False,
     "formatters": {
         "verbose": {
             "format": "%(levelname)-10s - %(asctime)s -%(module)-15s : %(message)s"
@@ -60,7 +59,5 @@ LOGGING_CONFIG = {
     }
 }
 
-dictConfig(LOGGING_CONFIG)
-
 if __name__ == '__main__':
     print(DISCORD_API_KEY)
@@ -9,6 +9,8 @@ class YoutubeSearchResult:
     title: str
     url: str | None
     watch_url: str
+    # The Discord user ID of the requester; display names are per-guild nicknames that can change.
+    added_by_id: int | None = None
 
     def __hash__(self):
         return self.uuid, self.uploader_name, self.url
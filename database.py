@@ -1,39 +1,93 @@
+import asyncio
+import gzip
+import json
 import math
+import os
+import re
 import sqlite3
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from sqlite3 import Connection, Cursor
-
-from pytube import YouTube
+from typing import Callable
 
 from data_classes import YoutubeSearchResult
+from decorators import run_in_executor
+from metrics import metrics
 
 HISTORY_TABLE_NAME = "YOUTUBE_BOT_HISTORY"
 PLAYLIST_TABLE_NAME = "YOUTUBE_BOT_PLAYLIST"
+METADATA_TABLE_NAME = "YOUTUBE_BOT_METADATA"
+GUILD_SETTINGS_TABLE_NAME = "YOUTUBE_BOT_GUILD_SETTINGS"
+PLAYER_STATE_TABLE_NAME = "YOUTUBE_BOT_PLAYER_STATE"
+HISTORY_SEARCH_TABLE_NAME = "YOUTUBE_BOT_HISTORY_SEARCH"
+HISTORY_COUNT_TABLE_NAME = "YOUTUBE_BOT_HISTORY_COUNTS"
+TRACK_STATS_TABLE_NAME = "YOUTUBE_BOT_TRACK_STATS"
+USER_STATS_TABLE_NAME = "YOUTUBE_BOT_USER_STATS"
+DAILY_STATS_TABLE_NAME = "YOUTUBE_BOT_DAILY_STATS"
+DATABASE_PATH = "history.db"
+HISTORY_RETENTION_DAYS = 7
+RETENTION_BATCH_SIZE = 500
+HISTORY_PAGE_SIZE = 10
+HISTORY_SEARCH_LIMIT = 5
+TOP_TRACKS_LIMIT = 10
+# History written before rows carried a guild belongs to the one server the bot was configured for.
+LEGACY_GUILD_ID = int(os.getenv("GUILD_ID") or 0)
+
+# Every query runs on this single worker thread against one long-lived connection, so coroutines awaiting the
+# database never block the event loop and SQLite never sees concurrent writers from this process.
+database_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-db")
+
+
+def run_in_database_thread(func: Callable):
+    return metrics.timed("database_call_seconds", function=func.__name__)(run_in_executor(database_executor)(func))
 
-sqlite_connection: Connection
-cursor: Cursor
+
+_database_connection: "DatabaseConnection | None" = None
 
 
 class DatabaseConnection:
 
-    def __init__(self):
-        self.sqlite_connection = sqlite3.connect("history.db")
-        self.cursor = self.sqlite_connection.cursor()
+    def __init__(self, database_path: str | None = None):
+        self.sqlite_connection: Connection = sqlite3.connect(database_path or DATABASE_PATH, cached_statements=256)
+        self.sqlite_connection.execute("PRAGMA journal_mode=WAL")
+        self.sqlite_connection.execute("PRAGMA synchronous=NORMAL")
+        self.cursor: Cursor = self.sqlite_connection.cursor()
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.sqlite_connection.close()
+        if exc_type is None:
+            self.sqlite_connection.commit()
+        else:
+            self.sqlite_connection.rollback()
 
-    def execute_commit_query(self, query: str):
-        self.cursor.execute(query)
+    def execute_commit_query(self, query: str, parameters: tuple = ()):
+        self.cursor.execute(query, parameters)
         self.sqlite_connection.commit()
 
+    def close(self):
+        self.cursor.close()
+        self.sqlite_connection.close()
+
+
+def get_database_connection() -> DatabaseConnection:
+    global _database_connection
+    if _database_connection is None:
+        _database_connection = DatabaseConnection()
+    return _database_connection
+
 
-def initialize_history_table():
-    create_table_query = f"""
+@run_in_database_thread
+def close_database():
+    global _database_connection
+    if _database_connection is not None:
+        _database_connection.close()
+        _database_connection = None
+
+
+SCHEMA_MIGRATIONS: list[str] = [
+    f"""
         CREATE TABLE IF NOT EXISTS {HISTORY_TABLE_NAME} (
             SEARCH_ID VARCHAR(255) NOT NULL, 
             ADDED_BY VARCHAR(255) NOT NULL,
@@ -41,97 +95,353 @@ def initialize_history_table():
             UPLOADER_NAME VARCHAR(255) NOT NULL,            
             WATCH_URL VARCHAR(255) NOT NULL,
             ADDED_AT VARCHAR(255) NOT NULL
-        ); """
-    with DatabaseConnection() as dbcon:
-        dbcon.execute_commit_query(create_table_query)
-
-
-def initialize_playlist_table():
-    create_table_query = f"""
+        );
         CREATE TABLE IF NOT EXISTS {PLAYLIST_TABLE_NAME} (            
             TITLE VARCHAR(255) NOT NULL,                                        
             WATCH_URL VARCHAR(255) NOT NULL,
             ADDED_AT VARCHAR(255) NOT NULL
-        ); """
-    with DatabaseConnection() as dbcon:
-        dbcon.execute_commit_query(create_table_query)
-
-
-def insert_playlist_item_to_history_db(youtube_item: YoutubeSearchResult):
-    check_existing_item_query = f'select * from {HISTORY_TABLE_NAME} WHERE WATCH_URL = \'{youtube_item.watch_url}\''
-    cleaned_added_by = youtube_item.added_by.replace("'", "''")
-    cleaned_title = youtube_item.title.replace("'", "''")
-    cleaned_uploader_name = youtube_item.uploader_name.replace("'", "''")
-    insert_query = f"INSERT INTO {HISTORY_TABLE_NAME} VALUES (" \
-                   f"'{youtube_item.uuid}', " \
-                   f"'{cleaned_added_by}', " \
-                   f"'{cleaned_title}', " \
-                   f"'{cleaned_uploader_name}', " \
-                   f"'{youtube_item.watch_url}', " \
-                   f"'{datetime.now()}'" \
-                   f")"
-    delete_query = f"DELETE FROM {HISTORY_TABLE_NAME} WHERE ADDED_AT <= date('now','-7 day')"
-    update_query = f"UPDATE {HISTORY_TABLE_NAME} " \
-                   f"SET ADDED_AT = '{datetime.now()}' " \
-                   f"WHERE WATCH_URL = '{youtube_item.watch_url}'"
-
-    with DatabaseConnection() as dbcon:
-        dbcon.cursor.execute(check_existing_item_query)
-        if dbcon.cursor.fetchall():
-            dbcon.cursor.execute(update_query)
-        else:
-            dbcon.cursor.execute(insert_query)
-        dbcon.cursor.execute(delete_query)
-        dbcon.sqlite_connection.commit()
+        );
+    """,
+    # ADDED_AT moves from local datetime strings to unix timestamps, rows are scoped to a guild, WATCH_URL becomes
+    # unique per guild (keeping the most recent play of each URL) and each guild's row count is maintained by triggers
+    # so paging never has to count the table.
+    f"""
+        CREATE TABLE {HISTORY_TABLE_NAME}_V2 (
+            GUILD_ID INTEGER NOT NULL,
+            SEARCH_ID VARCHAR(255) NOT NULL,
+            ADDED_BY VARCHAR(255) NOT NULL,
+            TITLE VARCHAR(255) NOT NULL,
+            UPLOADER_NAME VARCHAR(255) NOT NULL,
+            WATCH_URL VARCHAR(255) NOT NULL,
+            ADDED_AT REAL NOT NULL
+        );
+        INSERT INTO {HISTORY_TABLE_NAME}_V2
+            SELECT {LEGACY_GUILD_ID}, SEARCH_ID, ADDED_BY, TITLE, UPLOADER_NAME, WATCH_URL,
+                   COALESCE((julianday(MAX(ADDED_AT), 'utc') - 2440587.5) * 86400.0, 0)
+            FROM {HISTORY_TABLE_NAME}
+            GROUP BY WATCH_URL;
+        DROP TABLE {HISTORY_TABLE_NAME};
+        ALTER TABLE {HISTORY_TABLE_NAME}_V2 RENAME TO {HISTORY_TABLE_NAME};
+        CREATE UNIQUE INDEX {HISTORY_TABLE_NAME}_WATCH_URL ON {HISTORY_TABLE_NAME} (GUILD_ID, WATCH_URL);
+        CREATE INDEX {HISTORY_TABLE_NAME}_SEARCH_ID ON {HISTORY_TABLE_NAME} (SEARCH_ID);
+        CREATE INDEX {HISTORY_TABLE_NAME}_GUILD_ADDED_AT ON {HISTORY_TABLE_NAME} (GUILD_ID, ADDED_AT);
+        CREATE INDEX {HISTORY_TABLE_NAME}_ADDED_AT ON {HISTORY_TABLE_NAME} (ADDED_AT);
 
+        CREATE TABLE {METADATA_TABLE_NAME} (
+            KEY VARCHAR(255) PRIMARY KEY,
+            VALUE INTEGER NOT NULL
+        );
+        CREATE TABLE {HISTORY_COUNT_TABLE_NAME} (
+            GUILD_ID INTEGER PRIMARY KEY,
+            ROW_COUNT INTEGER NOT NULL
+        );
+        INSERT INTO {HISTORY_COUNT_TABLE_NAME} SELECT GUILD_ID, COUNT(*) FROM {HISTORY_TABLE_NAME} GROUP BY GUILD_ID;
+        CREATE TRIGGER {HISTORY_TABLE_NAME}_COUNT_INSERT AFTER INSERT ON {HISTORY_TABLE_NAME} BEGIN
+            INSERT INTO {HISTORY_COUNT_TABLE_NAME} (GUILD_ID, ROW_COUNT) VALUES (new.GUILD_ID, 1)
+                ON CONFLICT (GUILD_ID) DO UPDATE SET ROW_COUNT = ROW_COUNT + 1;
+        END;
+        CREATE TRIGGER {HISTORY_TABLE_NAME}_COUNT_DELETE AFTER DELETE ON {HISTORY_TABLE_NAME} BEGIN
+            UPDATE {HISTORY_COUNT_TABLE_NAME} SET ROW_COUNT = ROW_COUNT - 1 WHERE GUILD_ID = old.GUILD_ID;
+        END;
+    """,
+    f"""
+        CREATE TABLE {GUILD_SETTINGS_TABLE_NAME} (
+            GUILD_ID INTEGER PRIMARY KEY,
+            TEXT_CHANNEL_ID INTEGER NOT NULL
+        );
+    """,
+    # The playlist table was never written to; it is rebuilt to hold each guild's live queue, with the track that is
+    # playing and how far into it playback got kept in the player state table.
+    f"""
+        DROP TABLE {PLAYLIST_TABLE_NAME};
+        CREATE TABLE {PLAYLIST_TABLE_NAME} (
+            GUILD_ID INTEGER NOT NULL,
+            POSITION INTEGER NOT NULL,
+            SEARCH_ID VARCHAR(255) NOT NULL,
+            ADDED_BY VARCHAR(255) NOT NULL,
+            TITLE VARCHAR(255) NOT NULL,
+            UPLOADER_NAME VARCHAR(255) NOT NULL,
+            WATCH_URL VARCHAR(255) NOT NULL,
+            ADDED_BY_ID INTEGER,
+            PRIMARY KEY (GUILD_ID, POSITION)
+        ) WITHOUT ROWID;
+        CREATE TABLE {PLAYER_STATE_TABLE_NAME} (
+            GUILD_ID INTEGER PRIMARY KEY,
+            CURRENT_POSITION INTEGER,
+            PLAYBACK_OFFSET REAL NOT NULL,
+            VOICE_CHANNEL_ID INTEGER
+        );
+    """,
+    # An external-content FTS5 index over the history table: it stores only the index, reads column values back
+    # from the history rows, and is kept in step by triggers. Replays only touch ADDED_AT and skip the update trigger.
+    # GUILD_ID is indexed as a token, so a search only walks the matches from its own guild.
+    f"""
+        CREATE VIRTUAL TABLE {HISTORY_SEARCH_TABLE_NAME} USING fts5(
+            TITLE, UPLOADER_NAME, GUILD_ID,
+            content={HISTORY_TABLE_NAME}, content_rowid=rowid,
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        );
+        INSERT INTO {HISTORY_SEARCH_TABLE_NAME} ({HISTORY_SEARCH_TABLE_NAME}) VALUES ('rebuild');
+        CREATE TRIGGER {HISTORY_SEARCH_TABLE_NAME}_INSERT AFTER INSERT ON {HISTORY_TABLE_NAME} BEGIN
+            INSERT INTO {HISTORY_SEARCH_TABLE_NAME} (rowid, TITLE, UPLOADER_NAME, GUILD_ID)
+                VALUES (new.rowid, new.TITLE, new.UPLOADER_NAME, new.GUILD_ID);
+        END;
+        CREATE TRIGGER {HISTORY_SEARCH_TABLE_NAME}_DELETE AFTER DELETE ON {HISTORY_TABLE_NAME} BEGIN
+            INSERT INTO {HISTORY_SEARCH_TABLE_NAME} ({HISTORY_SEARCH_TABLE_NAME}, rowid, TITLE, UPLOADER_NAME, GUILD_ID)
+                VALUES ('delete', old.rowid, old.TITLE, old.UPLOADER_NAME, old.GUILD_ID);
+        END;
+        CREATE TRIGGER {HISTORY_SEARCH_TABLE_NAME}_UPDATE AFTER UPDATE OF TITLE, UPLOADER_NAME
+            ON {HISTORY_TABLE_NAME} BEGIN
+            INSERT INTO {HISTORY_SEARCH_TABLE_NAME} ({HISTORY_SEARCH_TABLE_NAME}, rowid, TITLE, UPLOADER_NAME, GUILD_ID)
+                VALUES ('delete', old.rowid, old.TITLE, old.UPLOADER_NAME, old.GUILD_ID);
+            INSERT INTO {HISTORY_SEARCH_TABLE_NAME} (rowid, TITLE, UPLOADER_NAME, GUILD_ID)
+                VALUES (new.rowid, new.TITLE, new.UPLOADER_NAME, new.GUILD_ID);
+        END;
+    """,
+    # Play counters that are bumped on every play and never purged, so top lists read a handful of index entries
+    # instead of aggregating history. Existing history rows are counted once each, since replays only kept the latest.
+    # Per-user counts are keyed by Discord user ID, which history rows do not have, so those start out empty.
+    f"""
+        CREATE TABLE {TRACK_STATS_TABLE_NAME} (
+            GUILD_ID INTEGER NOT NULL,
+            WATCH_URL VARCHAR(255) NOT NULL,
+            TITLE VARCHAR(255) NOT NULL,
+            UPLOADER_NAME VARCHAR(255) NOT NULL,
+            PLAY_COUNT INTEGER NOT NULL,
+            LAST_PLAYED_AT REAL NOT NULL,
+            PRIMARY KEY (GUILD_ID, WATCH_URL)
+        );
+        CREATE INDEX {TRACK_STATS_TABLE_NAME}_PLAY_COUNT ON {TRACK_STATS_TABLE_NAME} (GUILD_ID, PLAY_COUNT DESC);
+        CREATE TABLE {USER_STATS_TABLE_NAME} (
+            GUILD_ID INTEGER NOT NULL,
+            USER_ID INTEGER NOT NULL,
+            WATCH_URL VARCHAR(255) NOT NULL,
+            PLAY_COUNT INTEGER NOT NULL,
+            PRIMARY KEY (GUILD_ID, USER_ID, WATCH_URL)
+        ) WITHOUT ROWID;
+        CREATE INDEX {USER_STATS_TABLE_NAME}_PLAY_COUNT
+            ON {USER_STATS_TABLE_NAME} (GUILD_ID, USER_ID, PLAY_COUNT DESC);
+        CREATE TABLE {DAILY_STATS_TABLE_NAME} (
+            GUILD_ID INTEGER NOT NULL,
+            DAY VARCHAR(10) NOT NULL,
+            PLAY_COUNT INTEGER NOT NULL,
+            PRIMARY KEY (GUILD_ID, DAY)
+        ) WITHOUT ROWID;
+        INSERT INTO {TRACK_STATS_TABLE_NAME}
+            SELECT GUILD_ID, WATCH_URL, TITLE, UPLOADER_NAME, 1, ADDED_AT FROM {HISTORY_TABLE_NAME};
+        INSERT INTO {DAILY_STATS_TABLE_NAME}
+            SELECT GUILD_ID, date(ADDED_AT, 'unixepoch'), COUNT(*) FROM {HISTORY_TABLE_NAME} GROUP BY 1, 2;
+    """,
+]
 
-async def insert_playlist_item_to_playlist(youtube: YouTube):
-    insert_query = f"INSERT INTO {PLAYLIST_TABLE_NAME} VALUES (" \
-                   f"'{youtube.title}', " \
-                   f"'{youtube.watch_url}', " \
-                   f"'{datetime.now()}'" \
-                   f")"
-    with DatabaseConnection() as dbcon:
-        dbcon.execute_commit_query(insert_query)
 
+@run_in_database_thread
+def initialize_database():
+    with get_database_connection() as dbcon:
+        schema_version = dbcon.cursor.execute("PRAGMA user_version").fetchone()[0]
+        for version, migration in enumerate(SCHEMA_MIGRATIONS[schema_version:], start=schema_version + 1):
+            dbcon.sqlite_connection.executescript(f"BEGIN; {migration} PRAGMA user_version = {version}; COMMIT;")
 
-def get_un_played_playlist_urls():
-    with DatabaseConnection() as dbcon:
-        query = f'select * from {PLAYLIST_TABLE_NAME} ORDER BY ADDED_AT DESC'
-        dbcon.cursor.execute(query)
-        return [record[1] for record in dbcon.cursor.fetchall()]
+
+@run_in_database_thread
+def insert_playlist_item_to_history_db(guild_id: int, youtube_item: YoutubeSearchResult):
+    upsert_query = f"INSERT INTO {HISTORY_TABLE_NAME} " \
+                   f"(GUILD_ID, SEARCH_ID, ADDED_BY, TITLE, UPLOADER_NAME, WATCH_URL, ADDED_AT) " \
+                   f"VALUES (?, ?, ?, ?, ?, ?, ?) " \
+                   f"ON CONFLICT (GUILD_ID, WATCH_URL) DO UPDATE SET ADDED_AT = excluded.ADDED_AT"
+    track_stats_query = f"INSERT INTO {TRACK_STATS_TABLE_NAME} " \
+                        f"(GUILD_ID, WATCH_URL, TITLE, UPLOADER_NAME, PLAY_COUNT, LAST_PLAYED_AT) " \
+                        f"VALUES (?, ?, ?, ?, 1, ?) " \
+                        f"ON CONFLICT (GUILD_ID, WATCH_URL) DO UPDATE SET PLAY_COUNT = PLAY_COUNT + 1, " \
+                        f"TITLE = excluded.TITLE, UPLOADER_NAME = excluded.UPLOADER_NAME, " \
+                        f"LAST_PLAYED_AT = excluded.LAST_PLAYED_AT"
+    user_stats_query = f"INSERT INTO {USER_STATS_TABLE_NAME} (GUILD_ID, USER_ID, WATCH_URL, PLAY_COUNT) " \
+                       f"VALUES (?, ?, ?, 1) " \
+                       f"ON CONFLICT (GUILD_ID, USER_ID, WATCH_URL) DO UPDATE SET PLAY_COUNT = PLAY_COUNT + 1"
+    daily_stats_query = f"INSERT INTO {DAILY_STATS_TABLE_NAME} (GUILD_ID, DAY, PLAY_COUNT) VALUES (?, ?, 1) " \
+                        f"ON CONFLICT (GUILD_ID, DAY) DO UPDATE SET PLAY_COUNT = PLAY_COUNT + 1"
+
+    added_at = time.time()
+    with get_database_connection() as dbcon:
+        dbcon.cursor.execute(upsert_query, (guild_id,
+                                            youtube_item.uuid,
+                                            youtube_item.added_by,
+                                            youtube_item.title,
+                                            youtube_item.uploader_name,
+                                            youtube_item.watch_url,
+                                            added_at))
+        dbcon.cursor.execute(track_stats_query, (guild_id, youtube_item.watch_url, youtube_item.title,
+                                                 youtube_item.uploader_name, added_at))
+        if youtube_item.added_by_id is not None:
+            dbcon.cursor.execute(user_stats_query, (guild_id, youtube_item.added_by_id, youtube_item.watch_url))
+        dbcon.cursor.execute(daily_stats_query, (guild_id, time.strftime("%Y-%m-%d", time.gmtime(added_at))))
+
+
+@run_in_database_thread
+def delete_expired_history(cutoff: float, batch_size: int = RETENTION_BATCH_SIZE,
+                           archive_path: str | None = None) -> int:
+    # Deletes at most one batch of the oldest rows played before `cutoff`, found through the ADDED_AT index, so each
+    # call holds the write lock briefly and queued queries get the database thread in between batches.
+    # Archived rows are appended to a gzip file of JSON lines before the delete is committed.
+    columns = ["GUILD_ID", "SEARCH_ID", "ADDED_BY", "TITLE", "UPLOADER_NAME", "WATCH_URL", "ADDED_AT"]
+    with get_database_connection() as dbcon:
+        dbcon.cursor.execute(f"SELECT rowid, {', '.join(columns)} FROM {HISTORY_TABLE_NAME} "
+                             f"WHERE ADDED_AT <= ? ORDER BY ADDED_AT LIMIT ?", (cutoff, batch_size))
+        rows = dbcon.cursor.fetchall()
+        if not rows:
+            return 0
+        if archive_path:
+            with gzip.open(archive_path, "at", encoding="utf-8") as archive_file:
+                archive_file.writelines(json.dumps(dict(zip(columns, row[1:]))) + "\n" for row in rows)
+        dbcon.cursor.executemany(f"DELETE FROM {HISTORY_TABLE_NAME} WHERE rowid = ?", [(row[0],) for row in rows])
+    return len(rows)
 
 
-async def delete_oldest_playlist_entry():
-    delete_query = (f"DELETE FROM {PLAYLIST_TABLE_NAME}"
-                    f"ORDER BY ADDED_AT DESC"
-                    f"LIMIT 1")
-    with DatabaseConnection() as dbcon:
-        dbcon.execute_commit_query(delete_query)
+@run_in_database_thread
+def optimize_database(vacuum_interval: float, merge_search_index: bool = False) -> bool:
+    # Refreshes planner statistics from a bounded sample, merges the search index segments left behind by deleted
+    # rows, and rebuilds the file once `vacuum_interval` seconds have passed since the last VACUUM.
+    now = time.time()
+    with get_database_connection() as dbcon:
+        if merge_search_index:
+            dbcon.cursor.execute(f"INSERT INTO {HISTORY_SEARCH_TABLE_NAME} ({HISTORY_SEARCH_TABLE_NAME}) "
+                                 f"VALUES ('optimize')")
+        dbcon.cursor.execute("PRAGMA analysis_limit = 1000")
+        dbcon.cursor.execute("ANALYZE")
+        dbcon.cursor.execute(f"SELECT VALUE FROM {METADATA_TABLE_NAME} WHERE KEY = 'LAST_VACUUM_AT'")
+        row = dbcon.cursor.fetchone()
+        if row is None:
+            dbcon.cursor.execute(f"INSERT INTO {METADATA_TABLE_NAME} (KEY, VALUE) VALUES ('LAST_VACUUM_AT', ?)",
+                                 (int(now),))
+        vacuum_due = row is not None and now - row[0] >= vacuum_interval
+        if vacuum_due:
+            dbcon.cursor.execute(f"UPDATE {METADATA_TABLE_NAME} SET VALUE = ? WHERE KEY = 'LAST_VACUUM_AT'",
+                                 (int(now),))
+    if vacuum_due:
+        # VACUUM cannot run inside a transaction, so it runs after the block above has committed.
+        dbcon.cursor.execute("VACUUM")
+        dbcon.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return vacuum_due
 
 
+@run_in_database_thread
+def get_guild_text_channels() -> dict[int, int]:
+    with get_database_connection() as dbcon:
+        dbcon.cursor.execute(f"SELECT GUILD_ID, TEXT_CHANNEL_ID FROM {GUILD_SETTINGS_TABLE_NAME}")
+        return dict(dbcon.cursor.fetchall())
+
+
+@run_in_database_thread
+def set_guild_text_channel(guild_id: int, text_channel_id: int):
+    upsert_query = f"INSERT INTO {GUILD_SETTINGS_TABLE_NAME} (GUILD_ID, TEXT_CHANNEL_ID) VALUES (?, ?) " \
+                   f"ON CONFLICT (GUILD_ID) DO UPDATE SET TEXT_CHANNEL_ID = excluded.TEXT_CHANNEL_ID"
+    with get_database_connection() as dbcon:
+        dbcon.execute_commit_query(upsert_query, (guild_id, text_channel_id))
+
+
+@run_in_database_thread
+def save_queue_changes(queue_changes: list[tuple[int, bool, dict[int, YoutubeSearchResult | None]]],
+                       player_states: list[tuple[int, int | None, float, int | None]]):
+    upsert_query = f"INSERT OR REPLACE INTO {PLAYLIST_TABLE_NAME} " \
+                   f"(GUILD_ID, POSITION, SEARCH_ID, ADDED_BY, TITLE, UPLOADER_NAME, WATCH_URL, ADDED_BY_ID) " \
+                   f"VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+    state_query = f"INSERT OR REPLACE INTO {PLAYER_STATE_TABLE_NAME} " \
+                  f"(GUILD_ID, CURRENT_POSITION, PLAYBACK_OFFSET, VOICE_CHANNEL_ID) VALUES (?, ?, ?, ?)"
+    upserted_rows = []
+    deleted_rows = []
+    cleared_guilds = []
+    for guild_id, cleared, changes in queue_changes:
+        if cleared:
+            cleared_guilds.append((guild_id,))
+        for position, item in changes.items():
+            if item is None:
+                deleted_rows.append((guild_id, position))
+            else:
+                upserted_rows.append((guild_id, position, item.uuid, item.added_by, item.title, item.uploader_name,
+                                      item.watch_url, item.added_by_id))
+    with get_database_connection() as dbcon:
+        dbcon.cursor.executemany(f"DELETE FROM {PLAYLIST_TABLE_NAME} WHERE GUILD_ID = ?", cleared_guilds)
+        dbcon.cursor.executemany(f"DELETE FROM {PLAYER_STATE_TABLE_NAME} WHERE GUILD_ID = ?", cleared_guilds)
+        dbcon.cursor.executemany(f"DELETE FROM {PLAYLIST_TABLE_NAME} WHERE GUILD_ID = ? AND POSITION = ?",
+                                 deleted_rows)
+        dbcon.cursor.executemany(upsert_query, upserted_rows)
+        dbcon.cursor.executemany(state_query, player_states)
+
+
+@run_in_database_thread
+def get_saved_queues() -> dict[int, tuple[list[tuple[int, YoutubeSearchResult]], int | None, float, int | None]]:
+    saved_queues = {}
+    with get_database_connection() as dbcon:
+        dbcon.cursor.execute(f"SELECT GUILD_ID, POSITION, SEARCH_ID, ADDED_BY, TITLE, UPLOADER_NAME, WATCH_URL, "
+                             f"ADDED_BY_ID FROM {PLAYLIST_TABLE_NAME} ORDER BY GUILD_ID, POSITION")
+        for guild_id, position, search_id, added_by, title, uploader_name, watch_url, added_by_id in dbcon.cursor:
+            saved_queues.setdefault(guild_id, ([], None, 0.0, None))[0].append((position, YoutubeSearchResult(
+                uuid=search_id,
+                added_by=added_by,
+                uploader_name=uploader_name,
+                title=title,
+                url=None,
+                watch_url=watch_url,
+                added_by_id=added_by_id
+            )))
+        dbcon.cursor.execute(f"SELECT GUILD_ID, CURRENT_POSITION, PLAYBACK_OFFSET, VOICE_CHANNEL_ID "
+                             f"FROM {PLAYER_STATE_TABLE_NAME}")
+        for guild_id, current_position, playback_offset, voice_channel_id in dbcon.cursor.fetchall():
+            if guild_id in saved_queues:
+                saved_queues[guild_id] = (saved_queues[guild_id][0], current_position, playback_offset,
+                                          voice_channel_id)
+    return saved_queues
+
+
+@run_in_database_thread
 def print_history_entries():
-    with DatabaseConnection() as dbcon:
+    with get_database_connection() as dbcon:
         query = f'select * from {HISTORY_TABLE_NAME}'
         dbcon.cursor.execute(query)
         for item in dbcon.cursor:
             print(item)
 
 
-def get_recent_history_items(page: int) -> tuple[list[tuple], int]:
-    page_size = 10
-    with DatabaseConnection() as dbcon:
-        query = f'select * from {HISTORY_TABLE_NAME} ORDER BY ADDED_AT DESC'
-        dbcon.cursor.execute(query)
-        all_entries = dbcon.cursor.fetchall()
-        return all_entries[(page - 1) * page_size:page * page_size], int(math.ceil(len(all_entries) / page_size))
+@run_in_database_thread
+def get_history_row_count(guild_id: int) -> int:
+    with get_database_connection() as dbcon:
+        dbcon.cursor.execute(f"SELECT ROW_COUNT FROM {HISTORY_COUNT_TABLE_NAME} WHERE GUILD_ID = ?", (guild_id,))
+        row = dbcon.cursor.fetchone()
+        return row[0] if row else 0
 
 
-def get_search_result_for_search_id(search_id: str):
-    with DatabaseConnection() as dbcon:
-        query = f"select * from {HISTORY_TABLE_NAME} WHERE SEARCH_ID = '{search_id}'"
-        dbcon.cursor.execute(query)
-        found_result = next(dbcon.cursor)
+@run_in_database_thread
+def get_recent_history_items(guild_id: int, page: int, cursor: tuple[float, int] | None = None) \
+        -> tuple[list[tuple], int, tuple[float, int] | None]:
+    # `cursor` is the (ADDED_AT, rowid) of the last row of the previous page, as returned with it. Following it is a
+    # keyset seek on the (GUILD_ID, ADDED_AT) index that stays valid across writes; without one, `page` is reached
+    # by OFFSET.
+    page_size = HISTORY_PAGE_SIZE
+    columns = "SEARCH_ID, ADDED_BY, TITLE, UPLOADER_NAME, WATCH_URL, ADDED_AT, rowid"
+    with get_database_connection() as dbcon:
+        dbcon.cursor.execute(f"SELECT ROW_COUNT FROM {HISTORY_COUNT_TABLE_NAME} WHERE GUILD_ID = ?", (guild_id,))
+        row = dbcon.cursor.fetchone()
+        total_pages = int(math.ceil((row[0] if row else 0) / page_size))
+        if cursor:
+            query = f"SELECT {columns} FROM {HISTORY_TABLE_NAME} WHERE GUILD_ID = ? AND (ADDED_AT, rowid) < (?, ?) " \
+                    f"ORDER BY ADDED_AT DESC, rowid DESC LIMIT ?"
+            dbcon.cursor.execute(query, (guild_id, *cursor, page_size))
+        else:
+            query = f"SELECT {columns} FROM {HISTORY_TABLE_NAME} WHERE GUILD_ID = ? " \
+                    f"ORDER BY ADDED_AT DESC, rowid DESC LIMIT ? OFFSET ?"
+            dbcon.cursor.execute(query, (guild_id, page_size, (page - 1) * page_size))
+        rows = dbcon.cursor.fetchall()
+    next_cursor = (rows[-1][5], rows[-1][6]) if rows else None
+    return [row[:6] for row in rows], total_pages, next_cursor
+
+
+@run_in_database_thread
+def get_search_result_for_search_id(search_id: str) -> YoutubeSearchResult | None:
+    with get_database_connection() as dbcon:
+        query = f"SELECT SEARCH_ID, ADDED_BY, TITLE, UPLOADER_NAME, WATCH_URL FROM {HISTORY_TABLE_NAME} " \
+                f"WHERE SEARCH_ID = ?"
+        dbcon.cursor.execute(query, (search_id,))
+        found_result = dbcon.cursor.fetchone()
         if not found_result:
             return
         return YoutubeSearchResult(
@@ -144,9 +454,67 @@ def get_search_result_for_search_id(search_id: str):
         )
 
 
-if __name__ == '__main__':
-    initialize_history_table()
-    initialize_playlist_table()
+@run_in_database_thread
+def get_top_tracks(guild_id: int, user_id: int | None = None,
+                   limit: int = TOP_TRACKS_LIMIT) -> list[tuple[str, str, int]]:
+    # Both queries walk the guild's PLAY_COUNT indexes from the top, so they only ever touch `limit` rows.
+    if user_id is None:
+        query = f"SELECT TITLE, UPLOADER_NAME, PLAY_COUNT FROM {TRACK_STATS_TABLE_NAME} " \
+                f"WHERE GUILD_ID = ? ORDER BY PLAY_COUNT DESC LIMIT ?"
+        parameters = (guild_id, limit)
+    else:
+        query = f"SELECT tracks.TITLE, tracks.UPLOADER_NAME, users.PLAY_COUNT FROM {USER_STATS_TABLE_NAME} AS users " \
+                f"JOIN {TRACK_STATS_TABLE_NAME} AS tracks " \
+                f"ON tracks.GUILD_ID = users.GUILD_ID AND tracks.WATCH_URL = users.WATCH_URL " \
+                f"WHERE users.GUILD_ID = ? AND users.USER_ID = ? ORDER BY users.PLAY_COUNT DESC LIMIT ?"
+        parameters = (guild_id, user_id, limit)
+    with get_database_connection() as dbcon:
+        dbcon.cursor.execute(query, parameters)
+        return dbcon.cursor.fetchall()
+
+
+@run_in_database_thread
+def get_plays_on_day(guild_id: int, day: float) -> int:
+    # Days are counted in UTC.
+    with get_database_connection() as dbcon:
+        dbcon.cursor.execute(f"SELECT PLAY_COUNT FROM {DAILY_STATS_TABLE_NAME} WHERE GUILD_ID = ? AND DAY = ?",
+                             (guild_id, time.strftime("%Y-%m-%d", time.gmtime(day))))
+        row = dbcon.cursor.fetchone()
+        return row[0] if row else 0
+
+
+def build_history_search_query(guild_id: int, search_input: str) -> str:
+    # Every word must match the start of a word in the title or uploader name of a row from the guild; quoting keeps
+    # FTS5 operators and punctuation in user input from being parsed as query syntax.
+    words = " ".join(f'"{word}"*' for word in re.findall(r"\w+", search_input))
+    if not words:
+        return ""
+    return f'GUILD_ID : "{guild_id}" AND {{TITLE UPLOADER_NAME}} : ({words})'
+
+
+@run_in_database_thread
+def search_history(guild_id: int, search_input: str, limit: int = HISTORY_SEARCH_LIMIT) -> list[YoutubeSearchResult]:
+    match_query = build_history_search_query(guild_id, search_input)
+    if not match_query:
+        return []
+    query = f"SELECT history.SEARCH_ID, history.ADDED_BY, history.TITLE, history.UPLOADER_NAME, history.WATCH_URL " \
+            f"FROM {HISTORY_SEARCH_TABLE_NAME} " \
+            f"JOIN {HISTORY_TABLE_NAME} AS history ON history.rowid = {HISTORY_SEARCH_TABLE_NAME}.rowid " \
+            f"WHERE {HISTORY_SEARCH_TABLE_NAME} MATCH ? ORDER BY rank LIMIT ?"
+    with get_database_connection() as dbcon:
+        dbcon.cursor.execute(query, (match_query, limit))
+        return [YoutubeSearchResult(
+            uuid=search_id,
+            added_by=added_by,
+            uploader_name=uploader_name,
+            title=title,
+            url=None,
+            watch_url=watch_url
+        ) for search_id, added_by, title, uploader_name, watch_url in dbcon.cursor.fetchall()]
+
+
+async def main():
+    await initialize_database()
     # for i in range(20):
     #     time.sleep(1)
     #     insert_playlist_item(
@@ -169,4 +537,9 @@ if __name__ == '__main__':
     #     url="https://youtube.com/watch?v=dPfNdHNKHnk",
     #     watch_url="https://youtube.com/watch?v=dPfNdHNKHnk"
     # ))
-    print_history_entries()
+    await print_history_entries()
+    await close_database()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,12 +1,14 @@
-from threading import Thread
+import asyncio
+import functools
+from concurrent.futures import Executor
 from typing import Callable
 
 
-def threaded(daemon=False):
+def run_in_executor(executor: Executor):
     def decorator(func: Callable):
-        def wrapper(*args: tuple, **kwargs: dict):
-            new_thread = Thread(target=func, args=args, kwargs=kwargs, daemon=daemon)
-            new_thread.start()
-            return new_thread
+        @functools.wraps(func)
+        async def wrapper(*args: tuple, **kwargs: dict):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
         return wrapper
     return decorator
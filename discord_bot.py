@@ -1,34 +1,60 @@
 import asyncio
 import logging.handlers
 import os
-import re
 import sys
 import time
-import traceback
 import uuid
 import pathlib
+from dataclasses import replace
+from typing import Awaitable, Callable
 
 import discord
-from discord import Member, VoiceState, VoiceClient, VoiceChannel, Reaction, Message
-from discord.ext.commands import Cog, Bot, Context, command
-from pytube import Search, YouTube, StreamQuery, Stream, Playlist
+from discord import Member, VoiceState, VoiceChannel, Reaction, Message, Guild, Interaction
+from discord.abc import Messageable
+from discord.ext import tasks
+from discord.ext.commands import Cog, Bot, Context, command, guild_only, has_guild_permissions
+from pytube import YouTube
 
+from audio_cache import AudioCache
 from data_classes import YoutubeSearchResult
-from database import initialize_history_table, insert_playlist_item_to_history_db, get_recent_history_items, \
-    get_search_result_for_search_id
-from decorators import threaded
+from database import initialize_database, insert_playlist_item_to_history_db, get_recent_history_items, \
+    close_database, get_guild_text_channels, set_guild_text_channel, save_queue_changes, get_saved_queues, \
+    search_history, get_top_tracks, get_plays_on_day, delete_expired_history, optimize_database, HISTORY_PAGE_SIZE, \
+    HISTORY_RETENTION_DAYS, RETENTION_BATCH_SIZE
+from expiry_scheduler import ExpiryScheduler
+from log_queue import start_queue_listener, RateLimitFilter, SafeQueueListener
+from menus import NumberedChoiceView, NUMBER_EMOJIS, SearchMenu, HistoryMenu
+from metrics import metrics, LoopStallMonitor, MetricsServer
+from outbound import OutboundScheduler, Priority
+from search_cache import SearchCache
+from player_state import GuildPlayerState, GuildStateManager
+from playlist_ingest import PlaylistIngester
+from stream_cache import StreamCache, get_video_id
+from track_queue import Track
+from voice_presence import VoicePresenceTracker
 
 FFMPEG_OPTIONS = {"before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
                   "options": "-vn"}
+STREAM_PREFETCH_COUNT = 3
+PLAYLIST_STATUS_UPDATE_INTERVAL = 3
+QUEUE_DISPLAY_COUNT = 5
+SEARCH_MENU_TIMEOUT = 30
+HISTORY_MENU_TIMEOUT = 60
+TOP_TRACKS_TIMEOUT = 30
+MAX_PENDING_MENUS = 1000
+QUEUE_PERSIST_INTERVAL = 5
+HISTORY_COMPACT_INTERVAL = 60
+# The next track's FFmpeg process is started this long before the current track ends.
+PREWARM_LEAD_SECONDS = 15
 
 
 BASE_DIR = pathlib.Path(__file__).parent
 LOGS_DIR = BASE_DIR / "logs"
 
 
-def setup_logger():
+def setup_logger() -> SafeQueueListener:
     logger = logging.getLogger('discord')
-    logger.setLevel(logging.DEBUG)
+    logger.setLevel(os.getenv("LOG_LEVEL", "DEBUG").upper())
     logging.getLogger('discord.http').setLevel(logging.INFO)
     logger.addHandler(logging.StreamHandler(sys.stdout))
     handler = logging.handlers.RotatingFileHandler(
@@ -42,84 +68,268 @@ def setup_logger():
     formatter = logging.Formatter('[{asctime}] [{levelname:<8}] {name}: {message}', dt_fmt, style='{')
     handler.setFormatter(formatter)
     logger.addHandler(handler)
+    return start_queue_listener(logger, RateLimitFilter(rate=float(os.getenv("LOG_RATE_LIMIT", 50)),
+                                                        burst=float(os.getenv("LOG_RATE_BURST", 200)),
+                                                        debug_sample_rate=float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 1))))
 
 
 class YouTubePlayer(Cog):
 
     def __init__(self, bot: Bot):
         self.bot: Bot = bot
-        self.user_search_results = {}
-        self.playlist = []
-        self.is_playing = False
-        self.voice_client: VoiceClient | None = None
-        self.current_playlist_index = -1
+        self.pending_menus = ExpiryScheduler(ttl=SEARCH_MENU_TIMEOUT, max_size=MAX_PENDING_MENUS,
+                                             on_expire=self.on_menu_expired)
+        self.guild_states = GuildStateManager()
+        self.guild_text_channel_ids: dict[int, int] = {}
         self.logger = logging.getLogger("discord")
-        initialize_history_table()
-
-    #     self.add_unfinished_playlist_items_from_db()
-    #
-    # def add_unfinished_playlist_items_from_db(self):
-    #     un_played_urls = get_un_played_playlist_urls()
-
-    @Cog.listener()
-    async def on_voice_state_update(self, _member: Member, before: VoiceState, _voice_state: VoiceState):
-        bot_voice_clients: dict[VoiceChannel:VoiceClient] = {voice_client.channel: voice_client
-                                                             for voice_client in self.bot.voice_clients}
-        self.logger.debug(f"Voice State change detected.")
-        self.logger.debug(f"{before.channel = }")
-        if not before.channel:
+        self.outbound = OutboundScheduler()
+        self.search_cache = SearchCache()
+        self.stream_cache = StreamCache()
+        self.audio_cache = AudioCache.from_environment()
+        self.playlist_ingester = PlaylistIngester()
+        self.ingestion_tasks: set[asyncio.Task] = set()
+        self.background_tasks: set[asyncio.Task] = set()
+        self.voice_presence = VoicePresenceTracker(grace_period=float(os.getenv("VOICE_EMPTY_GRACE_PERIOD", 30)),
+                                                   on_empty=self.on_voice_channel_empty)
+        self.resume_playback_task: asyncio.Task | None = None
+        self.history_retention_days = float(os.getenv("HISTORY_RETENTION_DAYS", HISTORY_RETENTION_DAYS))
+        self.history_archive_path = os.getenv("HISTORY_ARCHIVE_PATH")
+        self.database_vacuum_interval = float(os.getenv("DATABASE_VACUUM_INTERVAL_HOURS", 24)) * 60 * 60
+        self.loop_stall_monitor = LoopStallMonitor(threshold=float(os.getenv("LOOP_STALL_THRESHOLD", 0.1)))
+        self.metrics_server = MetricsServer(port=int(os.environ["METRICS_PORT"])) if os.getenv("METRICS_PORT") else None
+
+    async def cog_load(self):
+        self.loop_stall_monitor.start()
+        if self.metrics_server:
+            await self.metrics_server.start()
+        await initialize_database()
+        self.guild_text_channel_ids = await get_guild_text_channels()
+        await self.restore_saved_queues()
+        self.evict_idle_guild_states.start()
+        self.persist_queues.start()
+        self.compact_history.start()
+
+    async def cog_unload(self):
+        self.evict_idle_guild_states.cancel()
+        self.persist_queues.cancel()
+        self.compact_history.cancel()
+        if self.resume_playback_task:
+            self.resume_playback_task.cancel()
+        for state in self.guild_states.values():
+            state.discard_prewarmed()
+        await self.persist_queues()
+        self.loop_stall_monitor.stop()
+        if self.metrics_server:
+            await self.metrics_server.stop()
+        self.pending_menus.clear()
+        self.voice_presence.close()
+        for background_task in self.background_tasks:
+            background_task.cancel()
+        self.outbound.close()
+        await close_database()
+        self.search_cache.close()
+        self.stream_cache.close()
+        if self.audio_cache:
+            await self.audio_cache.close()
+        for ingestion_task in self.ingestion_tasks:
+            ingestion_task.cancel()
+        self.playlist_ingester.close()
+
+    async def restore_saved_queues(self):
+        # Only metadata is restored here; stream URLs are resolved as each track comes up, like any queued track.
+        resumable_guilds = []
+        saved_queues = await get_saved_queues()
+        for guild_id, (rows, current_position, playback_offset, voice_channel_id) in saved_queues.items():
+            tracks = [Track(result, position) for position, result in rows]
+            # Playback only resumes into the exact track that was interrupted; it goes first so it picks up where it
+            # stopped.
+            interrupted = any(track.position == current_position for track in tracks)
+            if interrupted:
+                tracks.sort(key=lambda track: track.position != current_position)
+            self.guild_states.get(guild_id).queue.restore(tracks)
+            if voice_channel_id and interrupted:
+                resumable_guilds.append((guild_id, voice_channel_id, playback_offset))
+        if saved_queues:
+            self.logger.info(f"Restored queues for {len(saved_queues)} guilds")
+        if resumable_guilds:
+            self.resume_playback_task = asyncio.create_task(self.resume_saved_playback(resumable_guilds))
+
+    async def resume_saved_playback(self, resumable_guilds: list[tuple[int, int, float]]):
+        await self.bot.wait_until_ready()
+        for guild_id, voice_channel_id, playback_offset in resumable_guilds:
+            voice_channel = self.bot.get_channel(voice_channel_id)
+            if voice_channel is None or not any(not member.bot for member in voice_channel.members):
+                continue
+            text_channel_id = self.get_text_channel_id(voice_channel.guild)
+            text_channel = self.bot.get_channel(text_channel_id) if text_channel_id else None
+            if text_channel is None:
+                continue
+            state = self.guild_states.get(guild_id)
+            try:
+                state.voice_client = await voice_channel.connect()
+            except Exception:
+                self.logger.error(f"Failed to reconnect to voice channel {voice_channel_id} in guild {guild_id}")
+                continue
+            self.logger.info(f"Resuming playback in guild {guild_id} at {playback_offset:.0f}s")
+            await self.play_next_track(state, text_channel, playback_offset)
+
+    @tasks.loop(seconds=QUEUE_PERSIST_INTERVAL)
+    async def persist_queues(self):
+        # Queue changes collect in memory and are written in one transaction per interval, so commands and
+        # playlist imports never wait on the database.
+        queue_changes = []
+        player_states = []
+        taken_changes = []
+        saved_states = []
+        for state in self.guild_states.values():
+            cleared, changes = state.queue.take_changes()
+            if cleared or changes:
+                taken_changes.append((state, cleared, changes))
+                queue_changes.append((state.guild_id, cleared, {position: track.result if track else None
+                                                                for position, track in changes.items()}))
+            if state.is_playing and state.queue.current:
+                voice_channel_id = state.voice_client.channel.id \
+                    if state.voice_client and state.voice_client.is_connected() else None
+                player_states.append((state.guild_id, state.queue.current.position, state.playback_offset,
+                                      voice_channel_id))
+                saved_states.append((state, True))
+            elif state.playback_saved:
+                # Playback stopped without the queue being cleared (a disconnect or a failed connect), so a restart
+                # must not rejoin the channel or seek into whichever track is current by then.
+                player_states.append((state.guild_id, None, 0.0, None))
+                saved_states.append((state, False))
+        if not queue_changes and not player_states:
             return
-        self.logger.debug(f"{len(before.channel.members) = }")
-        self.logger.debug(f"{before.channel not in list(bot_voice_clients) = }")
-        if len(before.channel.members) - 1 > 1 or before.channel not in list(bot_voice_clients):
-            return
-        non_bot_members = list(filter(lambda member: not member.bot, before.channel.members))
-        self.logger.debug(f"Voice Channel has non bot member? {any(non_bot_members)}")
-        if non_bot_members:
-            return
-        self.playlist = []
-        self.is_playing = False
-        self.current_playlist_index = -1
-        await bot_voice_clients.get(before.channel).disconnect(force=True)
-        await self.bot.get_channel(
-            int(os.environ["TEXT_CHANNEL_ID"])
-        ).send("Leaving Voice Channel as all other users left!", delete_after=5)
-
-    @threaded(daemon=True)
-    def delete_expired_search(self, display_name: str, search_uuid: str):
-        time.sleep(30)
-        if not self.user_search_results.get(display_name):
+        try:
+            await save_queue_changes(queue_changes, player_states)
+        except Exception:
+            # An exception would stop the loop for good; the changes are kept and written with the next interval.
+            self.logger.exception(f"Failed to persist queues of {len(queue_changes)} guilds, retrying")
+            for state, cleared, changes in taken_changes:
+                state.queue.return_changes(cleared, changes)
             return
-        if not self.user_search_results.get(display_name).get(search_uuid):
+        for state, playback_saved in saved_states:
+            state.playback_saved = playback_saved
+
+    @tasks.loop(minutes=HISTORY_COMPACT_INTERVAL)
+    async def compact_history(self):
+        # Retention runs here rather than on every play; each batch is its own short transaction.
+        cutoff = time.time() - self.history_retention_days * 24 * 60 * 60
+        deleted_count = 0
+        try:
+            while True:
+                batch_count = await delete_expired_history(cutoff, archive_path=self.history_archive_path)
+                deleted_count += batch_count
+                if batch_count < RETENTION_BATCH_SIZE:
+                    break
+            if await optimize_database(self.database_vacuum_interval, merge_search_index=deleted_count > 0):
+                self.logger.info("Vacuumed the history database")
+        except Exception:
+            # An exception would stop the loop for good; whatever is left is picked up by the next run.
+            self.logger.exception("Failed to compact the history database, retrying next interval")
+        if deleted_count:
+            metrics.increment("history_rows_expired_total", deleted_count)
+            self.logger.info(f"Removed {deleted_count} history entries older than {self.history_retention_days} days")
+
+    @tasks.loop(minutes=5)
+    async def evict_idle_guild_states(self):
+        evicted_count = self.guild_states.evict_idle()
+        if evicted_count:
+            self.logger.debug(f"Evicted {evicted_count} idle guild players, {len(self.guild_states)} remaining")
+
+    def get_text_channel_id(self, guild: Guild) -> int | None:
+        if guild.id in self.guild_text_channel_ids:
+            return self.guild_text_channel_ids[guild.id]
+        if os.getenv("TEXT_CHANNEL_ID"):
+            return int(os.environ["TEXT_CHANNEL_ID"])
+        return None
+
+    def is_bot_text_channel(self, channel) -> bool:
+        guild = getattr(channel, "guild", None)
+        return guild is not None and channel.id == self.get_text_channel_id(guild)
+
+    @command(aliases=["bind"])
+    @guild_only()
+    @has_guild_permissions(manage_guild=True)
+    async def set_channel(self, context: Context):
+        self.outbound.delete_later(context.message, 5)
+        await set_guild_text_channel(context.guild.id, context.channel.id)
+        self.guild_text_channel_ids[context.guild.id] = context.channel.id
+        self.outbound.notify(context, f"Listening for song requests in #{context.channel.name}")
+
+    @Cog.listener()
+    async def on_voice_state_update(self, member: Member, before: VoiceState, after: VoiceState):
+        self.voice_presence.update(member, before, after)
+
+    def on_voice_channel_empty(self, channel: VoiceChannel):
+        self.logger.debug("No listeners left in %s for %ss, disconnecting", channel, self.voice_presence.grace_period)
+        disconnect_task = asyncio.create_task(self.leave_voice_channel(channel))
+        self.background_tasks.add(disconnect_task)
+        disconnect_task.add_done_callback(self.background_tasks.discard)
+
+    async def leave_voice_channel(self, channel: VoiceChannel):
+        state = self.guild_states.peek(channel.guild.id)
+        if state is None or not state.voice_client or not state.voice_client.is_connected():
             return
-        self.logger.debug(f"Deleting expired search result with ID: {search_uuid}, requested by {display_name}")
-        del self.user_search_results[display_name][search_uuid]
+        state.reset()
+        await state.voice_client.disconnect(force=True)
+        text_channel_id = self.get_text_channel_id(channel.guild)
+        if text_channel_id:
+            self.outbound.notify(self.bot.get_channel(text_channel_id),
+                                 "Leaving Voice Channel as all other users left!")
+
+    async def send_message(self, destination: Messageable, content: str, priority: Priority = Priority.HIGH,
+                           **kwargs) -> Message | None:
+        return await self.outbound.send(destination, content, priority, **kwargs)
+
+    def on_menu_expired(self, message_id: int, menu: SearchMenu | HistoryMenu):
+        self.logger.debug("Deleting expired %s for message ID: %s", type(menu).__name__, message_id)
 
     async def search_yt(self, context: Context, search_input: str):
         requester_name = context.author.name
-        await context.send(f"@{context.author.display_name}, "
-                           f"searching for \"{search_input}\"", delete_after=10)
-        search = Search(search_input)
-        self.logger.debug(f"New search query by {requester_name}: '{search}'")
-        top_3: list[YouTube] = [result for result in search.results[0:3] if not result.age_restricted]
+        self.outbound.notify(context, f"@{context.author.display_name}, searching for \"{search_input}\"",
+                             Priority.LOW, delete_after=10)
+        self.logger.debug("New search query by %s: '%s'", requester_name, search_input)
+        remote_search = asyncio.create_task(metrics.timed("youtube_search_seconds")(self.search_cache.search)(
+            search_input))
+        history_results = await search_history(context.guild.id, search_input)
         search_uuid = str(uuid.uuid4())
-        if self.user_search_results.get(requester_name):
-            self.user_search_results[requester_name][search_uuid] = top_3
-        else:
-            self.user_search_results[requester_name] = {search_uuid: top_3}
-        menu = [f"{index + 1} - {result.title} - {result.author}" for index, result in enumerate(top_3)]
-        self.logger.debug(f"{requester_name}: '{search}': {search_uuid}")
-        message = await context.send(
-            f"@{context.author.display_name}, "
-            f"Select one of the following (as reaction):\n" +
-            "\n".join(menu) +
-            f"\nSearch ID: {search_uuid}",
-            delete_after=30
-        )
-        self.delete_expired_search(context.author.display_name, search_uuid)
-        reaction_emojis = ["1️⃣", "2️⃣", "3️⃣"]
-        for emoji in reaction_emojis:
-            await message.add_reaction(emoji)
+        search_menu = SearchMenu(requester_id=context.author.id, search_id=search_uuid, results=[],
+                                 history_results=history_results)
+        self.logger.debug("%s: '%s': %s, %d history hits", requester_name, search_input, search_uuid,
+                          len(history_results))
+
+        async def on_select(interaction: Interaction, index: int):
+            await self.select_menu_entry(search_menu, interaction.message, interaction.user, index)
+
+        message = None
+        if history_results and not remote_search.done():
+            # History hits can be picked straight away; the YouTube results are added to the same menu later.
+            message = await self.send_search_menu(context, search_menu, on_select)
+        top_3: list[YouTube] = await remote_search
+        self.logger.debug("Search cache: %d hits, %d misses", self.search_cache.hits, self.search_cache.misses)
+        history_urls = {result.watch_url for result in history_results}
+        search_menu.results = [result for result in top_3 if result.watch_url not in history_urls]
+        await self.send_search_menu(context, search_menu, on_select, message, searching=False)
+
+    async def send_search_menu(self, context: Context, search_menu: SearchMenu,
+                               on_select: Callable[[Interaction, int], Awaitable], message: Message | None = None,
+                               searching: bool = True) -> Message | None:
+        menu = [f"{index + 1} - {result.title} - {result.uploader_name} (from history)"
+                for index, result in enumerate(search_menu.history_results)]
+        menu += [f"{len(menu) + index + 1} - {result.title} - {result.author}"
+                 for index, result in enumerate(search_menu.results)]
+        if searching:
+            menu.append("Searching YouTube...")
+        content = f"@{context.author.display_name}, Select one of the following:\n" + "\n".join(menu) + \
+                  f"\nSearch ID: {search_menu.search_id}"
+        view = NumberedChoiceView(len(search_menu), on_select, requester_id=search_menu.requester_id,
+                                  timeout=SEARCH_MENU_TIMEOUT)
+        if message is not None:
+            return await self.outbound.edit(message, content, Priority.HIGH, view=view)
+        message = await self.send_message(context, content, view=view, delete_after=SEARCH_MENU_TIMEOUT)
+        self.pending_menus.add(message.id, search_menu, ttl=SEARCH_MENU_TIMEOUT)
+        return message
 
     # @command()
     # async def pause(self):
@@ -130,105 +340,224 @@ class YouTubePlayer(Cog):
     #     ...
     #
     @command(aliases=["s"])
+    @guild_only()
     async def skip(self, context: Context, *args: tuple):
-        await context.message.delete(delay=5)
+        self.outbound.delete_later(context.message, 5)
+        state = self.guild_states.get(context.guild.id)
         if args and str(args[0]).isnumeric():
             skip_amount = int(str(args[0])) - 1
         else:
             skip_amount = 0
-        if len(self.playlist[self.current_playlist_index - 1:]) < skip_amount and skip_amount > 0:
-            skip_amount = len(self.playlist[self.current_playlist_index - 1:]) - 1
-        if self.voice_client is not None:
-            self.current_playlist_index += skip_amount
-            self.voice_client.stop()
-            await context.send(f"Skipped {skip_amount + 1} songs", delete_after=4)
+        if state.voice_client is not None:
+            skip_amount = state.queue.skip(skip_amount)
+            if skip_amount:
+                state.discard_prewarmed()
+            state.voice_client.stop()
+            self.outbound.notify(context, f"Skipped {skip_amount + 1} songs", delete_after=4)
 
     @command(aliases=["q"])
+    @guild_only()
     async def queue(self, context: Context):
-        await context.message.delete(delay=5)
+        self.outbound.delete_later(context.message, 5)
+        state = self.guild_states.get(context.guild.id)
         retval = "Playlist:\n"
-        for i in range(self.current_playlist_index, len(self.playlist)):
-            if self.current_playlist_index >= len(self.playlist) - 1 and not self.is_playing:
-                break
-            if i > self.current_playlist_index + 4:
-                break
-            if (i == self.current_playlist_index and self.current_playlist_index < len(self.playlist)
-                    and self.is_playing):
-                retval += "► "
-            retval += f"{list(self.playlist[i].values())[0].title}\n"
-        if retval != "Playlist:\n":
-            await context.send(retval, delete_after=5)
-        else:
-            await context.send("Queue empty", delete_after=5)
+        shown_count = 0
+        if state.is_playing and state.queue.current:
+            retval += f"► {state.queue.current.result.title}\n"
+            shown_count += 1
+        for track in state.queue.peek(QUEUE_DISPLAY_COUNT - shown_count):
+            retval += f"{track.result.title}\n"
+        if retval == "Playlist:\n":
+            retval = "Queue empty"
+        self.outbound.notify(context, retval, coalesce_key="queue", replace=True)
 
     @command(aliases=["his"])
+    @guild_only()
     async def history(self, context: Context, *args: tuple):
-        await context.message.delete(delay=5)
+        self.outbound.delete_later(context.message, 5)
         page = 1
         if args:
-            if str(args[0][0]).strip().isnumeric():
-                page = int(str(args[0][0]).strip())
-        history_items, total_pages = get_recent_history_items(page)
-        history_items = [f"{(page - 1) * 10 + index + 1}) {item[2]} - {item[3]} (Added by {item[1]}) (ID: {item[0]})"
-                         for index, item in enumerate(history_items)]
-        history_items_string = '\n'.join(history_items)
-        message = await context.send(f"Playback history (Page {page} out of {total_pages}): \n"
-                                     f"{history_items_string}", delete_after=60)
-        reaction_emojis = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
-        for i in range(len(history_items)):
-            await message.add_reaction(reaction_emojis[i])
-
-    async def play_selected_track(self, selected_track: YouTube, search_id: str,
-                                  user: Member, context: Context):
-
-        def get_best_audio_stream(audio_streams: StreamQuery):
-            best_stream = None
-            for stream_ in audio_streams.fmt_streams:
-                if not best_stream:
-                    best_stream = stream_
-                    continue
-                if stream_.abr > best_stream.abr:
-                    best_stream = stream_
-            return best_stream
-
-        def get_best_video_stream(video_streams: StreamQuery):
-            best_stream = None
-            for stream_ in video_streams.fmt_streams:
-                if not best_stream:
-                    best_stream = stream_
-                    continue
-                if stream_.resolution > best_stream.resolution:
-                    best_stream = stream_
-            return best_stream
-
-        audio_only_streams = selected_track.streams.filter(only_audio=True)
-        progressive_stream = selected_track.streams.filter(progressive=True)
-        if audio_only_streams:
-            self.logger.debug(f"{search_id}: Found Audio Only stream, proceeding with it.")
-            stream: Stream = get_best_audio_stream(audio_only_streams)
-            url = stream.url
+            page_argument = "".join(args[0]).strip()
+            if page_argument.isnumeric():
+                page = int(page_argument)
+        if page < 1:
+            self.outbound.notify(context, "History pages start at 1")
+            return
+        history_rows, total_pages, next_cursor = await get_recent_history_items(context.guild.id, page)
+        history_menu = HistoryMenu(entries=self.create_history_entries(history_rows), page=page,
+                                   total_pages=total_pages, next_cursor=next_cursor)
+        await self.send_history_menu(context, self.get_history_page_header(history_menu), history_menu)
+
+    @staticmethod
+    def create_history_entries(history_rows: list[tuple]) -> list[YoutubeSearchResult]:
+        return [YoutubeSearchResult(uuid=row[0], added_by=row[1], title=row[2], uploader_name=row[3], url=None,
+                                    watch_url=row[4])
+                for row in history_rows]
+
+    @staticmethod
+    def get_history_page_header(history_menu: HistoryMenu) -> str:
+        return f"Playback history (Page {history_menu.page} out of {history_menu.total_pages}): "
+
+    @command(aliases=["f"])
+    @guild_only()
+    async def find(self, context: Context, *args: str):
+        self.outbound.delete_later(context.message, 5)
+        search_input = " ".join(args)
+        history_results = await search_history(context.guild.id, search_input, HISTORY_PAGE_SIZE)
+        if not history_results:
+            self.outbound.notify(context, f"No tracks in history match \"{search_input}\"")
+            return
+        await self.send_history_menu(context, f"History matches for \"{search_input}\":",
+                                     HistoryMenu(entries=history_results))
+
+    @command()
+    @guild_only()
+    async def top(self, context: Context, *args: str):
+        self.outbound.delete_later(context.message, 5)
+        user_id = context.author.id if args and args[0].lower() == "me" else None
+        if user_id:
+            top_tracks = await get_top_tracks(context.guild.id, user_id)
+            header = f"Most played by {context.author.display_name}:"
+        else:
+            top_tracks = await get_top_tracks(context.guild.id)
+            plays_today = await get_plays_on_day(context.guild.id, time.time())
+            header = f"Most played tracks ({plays_today} plays since 00:00 UTC):"
+        if not top_tracks:
+            self.outbound.notify(context, "Nothing has been played yet")
+            return
+        top_tracks_string = "\n".join(f"{number}) {title} - {uploader_name} ({play_count} plays)"
+                                      for number, (title, uploader_name, play_count) in enumerate(top_tracks, 1))
+        self.outbound.notify(context, f"{header}\n{top_tracks_string}", delete_after=TOP_TRACKS_TIMEOUT,
+                             coalesce_key=("top", user_id), replace=True)
+
+    async def send_history_menu(self, context: Context, header: str, history_menu: HistoryMenu):
+        message = await self.send_message(context, self.format_history_menu(header, history_menu),
+                                          view=self.create_history_view(history_menu),
+                                          delete_after=HISTORY_MENU_TIMEOUT)
+        self.pending_menus.add(message.id, history_menu, ttl=HISTORY_MENU_TIMEOUT)
+
+    @staticmethod
+    def format_history_menu(header: str, history_menu: HistoryMenu) -> str:
+        first_number = (history_menu.page - 1) * HISTORY_PAGE_SIZE + 1
+        history_items = [f"{first_number + index}) {item.title} - {item.uploader_name} (Added by {item.added_by}) "
+                         f"(ID: {item.uuid})"
+                         for index, item in enumerate(history_menu.entries)]
+        return f"{header}\n" + "\n".join(history_items)
+
+    def create_history_view(self, history_menu: HistoryMenu) -> NumberedChoiceView:
+        async def on_select(interaction: Interaction, index: int):
+            await self.select_menu_entry(history_menu, interaction.message, interaction.user, index)
+
+        async def on_next_page(interaction: Interaction):
+            await self.show_next_history_page(history_menu, interaction.message)
+
+        has_next_page = history_menu.next_cursor is not None and history_menu.page < history_menu.total_pages
+        return NumberedChoiceView(len(history_menu), on_select, timeout=HISTORY_MENU_TIMEOUT,
+                                  on_next_page=on_next_page if has_next_page else None)
+
+    async def show_next_history_page(self, history_menu: HistoryMenu, menu_message: Message):
+        page = history_menu.page + 1
+        history_rows, total_pages, next_cursor = await get_recent_history_items(menu_message.guild.id, page,
+                                                                                history_menu.next_cursor)
+        # A second click that arrived while this page was loading would otherwise skip a page.
+        if not history_rows or history_menu.page + 1 != page:
+            return
+        history_menu.entries = self.create_history_entries(history_rows)
+        history_menu.page = page
+        history_menu.total_pages = total_pages
+        history_menu.next_cursor = next_cursor
+        await self.outbound.edit(menu_message,
+                                 self.format_history_menu(self.get_history_page_header(history_menu), history_menu),
+                                 Priority.HIGH, view=self.create_history_view(history_menu))
+        # Each page gets the full timeout again, so a menu is not deleted while someone is still paging through it.
+        self.pending_menus.add(menu_message.id, history_menu, ttl=HISTORY_MENU_TIMEOUT)
+        self.outbound.delete_later(menu_message, HISTORY_MENU_TIMEOUT)
+
+    async def select_menu_entry(self, menu: SearchMenu | HistoryMenu, menu_message: Message, user: Member,
+                                index: int):
+        if index >= len(menu):
+            return
+        if isinstance(menu, SearchMenu):
+            if user.id != menu.requester_id:
+                return
+            if index < len(menu.history_results):
+                selected_result = replace(menu.history_results[index], uuid=menu.search_id,
+                                          added_by=user.display_name, added_by_id=user.id)
+            else:
+                selected_track = menu.results[index - len(menu.history_results)]
+                selected_result = YoutubeSearchResult(
+                    uuid=menu.search_id,
+                    added_by=user.display_name,
+                    uploader_name=selected_track.author,
+                    title=selected_track.title,
+                    url=None,
+                    watch_url=selected_track.watch_url,
+                    added_by_id=user.id
+                )
         else:
-            self.logger.debug(f"{search_id}: No Audio Only streams found, proceeding with Video Stream.")
-            stream: Stream = get_best_video_stream(progressive_stream)
-            url = stream.url
-        selected_youtube_search_result = YoutubeSearchResult(
-            uuid=search_id,
-            added_by=user.display_name,
-            uploader_name=selected_track.author,
-            title=selected_track.title,
-            url=url,
-            watch_url=selected_track.watch_url
-        )
-        self.playlist.append({search_id: selected_youtube_search_result})
-        await context.send(f"Added to queue: {selected_track.title}", delete_after=5)
-        self.logger.debug(f"play_selected_track: {self.is_playing = }")
-        if not self.is_playing:
+            selected_result = replace(menu.entries[index], added_by=user.display_name, added_by_id=user.id)
+        context: Context = await self.bot.get_context(menu_message)
+        await self.play_selected_track(selected_result, user, context)
+
+    async def play_selected_track(self, selected_track: YoutubeSearchResult, user: Member, context: Context):
+        state = self.guild_states.get(context.guild.id)
+        state.queue.append(selected_track)
+        self.outbound.notify(context, f"Added to queue: {selected_track.title}", Priority.LOW,
+                             coalesce_key="added_to_queue")
+        self.prefetch_upcoming_streams(state)
+        self.ensure_prewarm(state)
+        self.logger.debug("play_selected_track: state.is_playing = %s", state.is_playing)
+        if not state.is_playing:
             await self.play_youtube_audio(context, user)
 
+    def prefetch_upcoming_streams(self, state: GuildPlayerState):
+        upcoming_tracks = [track.result for track in state.queue.peek(STREAM_PREFETCH_COUNT)]
+        if self.audio_cache:
+            upcoming_tracks = [track for track in upcoming_tracks
+                               if get_video_id(track.watch_url) not in self.audio_cache]
+        self.stream_cache.prefetch(upcoming_tracks)
+
+    @staticmethod
+    def get_target_bitrate_kbps(state: GuildPlayerState) -> int | None:
+        # Discord encodes voice at the channel's bitrate, so streams above it only cost bandwidth.
+        if not state.voice_client or not state.voice_client.channel:
+            return None
+        return state.voice_client.channel.bitrate // 1000
+
+    async def queue_playlist(self, context: Context, user: Member, playlist_url: str):
+        state = self.guild_states.get(context.guild.id)
+        status_key = ("playlist", uuid.uuid4())
+        self.outbound.notify(context, "Loading playlist...", Priority.LOW, delete_after=None, coalesce_key=status_key)
+        added_count = 0
+        failed_count = 0
+        connect_failed = False
+        last_status_update = time.monotonic()
+        async for track in self.playlist_ingester.ingest(playlist_url, user.display_name, user.id):
+            if track is None:
+                failed_count += 1
+                continue
+            state.queue.append(track)
+            added_count += 1
+            if not state.is_playing and not connect_failed:
+                await self.play_youtube_audio(context, user)
+                # After one failed connect the rest of the playlist is only queued, instead of retrying per track.
+                connect_failed = not state.voice_client or not state.voice_client.is_connected()
+            else:
+                self.prefetch_upcoming_streams(state)
+                self.ensure_prewarm(state)
+            if time.monotonic() - last_status_update >= PLAYLIST_STATUS_UPDATE_INTERVAL:
+                last_status_update = time.monotonic()
+                self.outbound.notify(context, f"Loading playlist... {added_count} tracks added to queue",
+                                     Priority.LOW, delete_after=None, coalesce_key=status_key, replace=True)
+        failed_text = f" ({failed_count} could not be loaded)" if failed_count else ""
+        self.outbound.notify(context, f"Added {added_count} tracks from playlist to queue{failed_text}",
+                             delete_after=10, coalesce_key=status_key, replace=True)
+
     @command(aliases=["cm"])
+    @guild_only()
     async def clear_messages(self, context: Context):
-        await context.message.delete(delay=5)
-        await context.send("Clearing Messages in Text Channel", delete_after=5)
+        self.outbound.delete_later(context.message, 5)
+        self.outbound.notify(context, "Clearing Messages in Text Channel")
         await self.clear_all_messages_in_bot_text_channel(context)
 
     @staticmethod
@@ -239,127 +568,195 @@ class YouTubePlayer(Cog):
 
     @command(aliases=["rs"])
     async def restart(self, context: Context):
-        await context.message.delete(delay=2)
-        await context.send("Restarting Bot!", delete_after=2)
-        time.sleep(2)
+        self.outbound.delete_later(context.message, 2)
+        await self.send_message(context, "Restarting Bot!", delete_after=2)
+        await asyncio.sleep(2)
+        await self.persist_queues()
         sys.exit(0)
 
     @command(aliases=["dc", "l"])
     async def disconnect(self, context: Context):
-        await context.message.delete(delay=2)
-        await context.send("Disconnecting from Voice Channel!", delete_after=2)
-        time.sleep(2)
+        self.outbound.delete_later(context.message, 2)
+        await self.send_message(context, "Disconnecting from Voice Channel!", delete_after=2)
+        await asyncio.sleep(2)
         await context.voice_client.disconnect(force=True)
 
     @Cog.listener()
     async def on_reaction_add(self, reaction: Reaction, user: Member):
-
-        async def check_search_result():
-            re_matches = re.search(r".*Search ID: (?P<search_id>.+)", message)
-            if not re_matches:
-                return
-            search_id = re_matches.group("search_id")
-            search_results: list[YouTube] = self.user_search_results[user.name][search_id]
-            choice = str(reaction.emoji)
-            reaction_emojis = ["1️⃣", "2️⃣", "3️⃣"]
-            if choice not in reaction_emojis:
-                return
-            selected_track: YouTube | None = None
-            if choice == "1️⃣":
-                selected_track = search_results[0]
-            elif choice == "2️⃣":
-                selected_track = search_results[1]
-            elif choice == "3️⃣":
-                selected_track = search_results[2]
-            # await insert_playlist_item_to_playlist(selected_track)
-
-            await self.play_selected_track(selected_track, search_id, user, context)
-
-        async def check_history_result():
-            history_entries = message.split("\n")[1:]
-            choice = str(reaction.emoji)
-            reaction_emojis = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
-            if choice not in reaction_emojis[:len(history_entries)]:
-                return
-
-            selected_track: str | YouTube | None = None
-            for index, emoji in enumerate(reaction_emojis):
-                if choice == emoji:
-                    selected_track = history_entries[index]
-            if not selected_track:
-                return
-            re_matches = re.search(r".*\(ID: (?P<search_id>.+)\)", selected_track)
-            if not re_matches:
-                return
-            search_id = re_matches.group("search_id")
-
-            search_result: YoutubeSearchResult = get_search_result_for_search_id(search_id)
-            selected_track = YouTube(search_result.watch_url)
-            # await insert_playlist_item_to_playlist(selected_track)
-            await self.play_selected_track(selected_track, search_id, user, context)
-
-        if user.bot or reaction.message.channel.id != int(os.environ["TEXT_CHANNEL_ID"]):
+        if user.bot:
+            return
+        menu = self.pending_menus.get(reaction.message.id)
+        if menu is None:
+            return
+        choice = str(reaction.emoji)
+        if choice not in NUMBER_EMOJIS:
             return
-        context: Context = await self.bot.get_context(reaction.message)
-        message: str = str(reaction.message.clean_content)
-        await check_search_result()
-        await check_history_result()
-        # await reaction.message.delete()
+        await self.select_menu_entry(menu, reaction.message, user, NUMBER_EMOJIS.index(choice))
 
     async def play_youtube_audio(self, context: Context, user: Member = None):
+        state = self.guild_states.get(context.guild.id)
 
         async def connect_to_voice_channel():
-            if not self.voice_client or not self.voice_client.is_connected():
+            if not state.voice_client or not state.voice_client.is_connected():
                 if user:
                     if user.voice:
-                        self.voice_client = await user.voice.channel.connect()
+                        state.voice_client = await user.voice.channel.connect()
                     else:
-                        await context.send("Requester not connected to any voice channel", delete_after=5)
+                        self.outbound.notify(context, "Requester not connected to any voice channel", Priority.HIGH)
                         raise Exception("Requester not connected to any voice channel")
                 else:
-                    self.voice_client = await context.author.voice.channel.connect()
-                if not self.voice_client:
-                    await context.send("Could not connect to the voice channel", delete_after=5)
+                    state.voice_client = await context.author.voice.channel.connect()
+                if not state.voice_client:
+                    self.outbound.notify(context, "Could not connect to the voice channel", Priority.HIGH)
                     return
             else:
-                await self.voice_client.move_to(context.author.voice.channel)
+                await state.voice_client.move_to(context.author.voice.channel)
 
-        if self.current_playlist_index == len(self.playlist) - 1:
-            self.is_playing = False
+        if not state.queue:
+            state.is_playing = False
             return
 
-        self.is_playing = True
-        self.current_playlist_index += 1
+        # Connect before taking the track off the queue, so it stays queued when the requester is not in a channel.
+        state.is_playing = True
         try:
             await connect_to_voice_channel()
         except:
-            self.logger.error("Failed to connect to Voice Client")
-            self.is_playing = False
-            print(traceback.format_exc())
+            self.logger.exception("Failed to connect to Voice Client")
+            state.is_playing = False
+            return
+        playing_track = state.queue.advance()
+        if playing_track is None:
+            state.is_playing = False
+            return
+        await self.play_track(state, context, playing_track)
+
+    async def play_next_track(self, state: GuildPlayerState, destination: Messageable, start_offset: float = 0.0):
+        if not state.voice_client or not state.voice_client.is_connected():
+            state.is_playing = False
+            state.discard_prewarmed()
+            return
+        playing_track = state.queue.advance()
+        if playing_track is None:
+            state.is_playing = False
+            state.discard_prewarmed()
+            return
+        state.is_playing = True
+        await self.play_track(state, destination, playing_track, start_offset)
+
+    async def create_audio_source(self, playing_item: YoutubeSearchResult, start_offset: float = 0.0,
+                                  target_kbps: int | None = None) -> tuple[discord.AudioSource, float | None]:
+        video_id = get_video_id(playing_item.watch_url)
+        seek_option = f"-ss {start_offset:.2f} " if start_offset else ""
+        cached_audio_path = self.audio_cache.get_path(video_id) if self.audio_cache else None
+        if cached_audio_path:
+            self.logger.debug("%s: Playing cached audio from %s", playing_item.uuid, cached_audio_path)
+            audio_source = await discord.FFmpegOpusAudio.from_probe(str(cached_audio_path),
+                                                                    before_options=seek_option.strip() or None,
+                                                                    options=FFMPEG_OPTIONS["options"])
+            return audio_source, None
+        resolved_stream = await self.stream_cache.resolve(playing_item.watch_url, target_kbps)
+        playing_item.url = resolved_stream.url
+        # Opus streams are remuxed as-is; anything else is transcoded to Opus inside FFmpeg. discord.py 2.3 turns
+        # "copy" into libopus, while "opus" means a stream copy in every version.
+        codec = "opus" if resolved_stream.is_opus else None
+        self.logger.debug("%s: Playing %s (%s) with %s", playing_item.uuid, resolved_stream.mime_type,
+                          resolved_stream.audio_codec, "copy" if codec else "libopus")
+        audio_source = discord.FFmpegOpusAudio(playing_item.url, codec=codec,
+                                               before_options=seek_option + FFMPEG_OPTIONS["before_options"],
+                                               options=FFMPEG_OPTIONS["options"])
+        return audio_source, resolved_stream.duration
+
+    async def play_track(self, state: GuildPlayerState, destination: Messageable, playing_track: Track,
+                         start_offset: float = 0.0):
+        playing_item: YoutubeSearchResult = playing_track.result
+        audio_source = state.take_prewarmed(playing_track) if not start_offset else None
+        duration = None
+        if audio_source is None:
+            try:
+                audio_source, duration = await self.create_audio_source(playing_item, start_offset,
+                                                                        self.get_target_bitrate_kbps(state))
+            except Exception:
+                self.logger.exception(f"{playing_item.uuid}: Failed to resolve stream for {playing_item.watch_url}")
+                self.outbound.notify(destination, f"Could not load: {playing_item.title}", Priority.HIGH,
+                                     delete_after=10)
+                await self.play_next_track(state, destination)
+                return
         else:
-            playing_item: YoutubeSearchResult = list(self.playlist[self.current_playlist_index].values())[0]
-            await context.send(f"Now playing: {playing_item.title} - (Channel: {playing_item.uploader_name})",
-                               delete_after=10)
-            insert_playlist_item_to_history_db(playing_item)
-            self.voice_client.play(discord.FFmpegPCMAudio(playing_item.url, **FFMPEG_OPTIONS),
-                                   after=lambda e: asyncio.run_coroutine_threadsafe(self.play_youtube_audio(context),
-                                                                                    self.bot.loop))
+            resolved_stream = self.stream_cache.get(playing_item.watch_url, self.get_target_bitrate_kbps(state))
+            duration = resolved_stream.duration if resolved_stream else None
+        state.start_track(start_offset)
+        state.voice_client.play(audio_source,
+                                after=lambda e: asyncio.run_coroutine_threadsafe(
+                                    self.play_next_track(state, destination), self.bot.loop))
+        self.schedule_prewarm(state, None if duration is None else duration - start_offset)
+        self.prefetch_upcoming_streams(state)
+        self.store_played_audio(playing_item)
+        self.outbound.notify(destination,
+                             f"Now playing: {playing_item.title} - (Channel: {playing_item.uploader_name})",
+                             delete_after=10, coalesce_key="now_playing", replace=True)
+        await insert_playlist_item_to_history_db(state.guild_id, playing_item)
+
+    def store_played_audio(self, playing_item: YoutubeSearchResult):
+        # Only tracks that actually play are cached, and always from the highest-bitrate stream, since the copy is
+        # replayed in channels of any bitrate. The stream cache still holds every candidate, so this resolves nothing.
+        if not self.audio_cache:
+            return
+        best_stream = self.stream_cache.get(playing_item.watch_url)
+        if best_stream:
+            self.audio_cache.store_in_background(get_video_id(playing_item.watch_url), best_stream.url)
+
+    def schedule_prewarm(self, state: GuildPlayerState, remaining: float | None):
+        # Without a known duration the next source is started right away; FFmpeg then just waits on a full pipe.
+        state.discard_prewarmed()
+        delay = 0 if remaining is None else max(0.0, remaining - PREWARM_LEAD_SECONDS)
+        state.prewarm_due_at = asyncio.get_running_loop().time() + delay
+        self.ensure_prewarm(state)
+
+    def ensure_prewarm(self, state: GuildPlayerState):
+        # Also called when tracks are queued, for when the queue was empty at the time the prewarm was due.
+        if not state.is_playing or state.prewarm_handle or state.prewarmed_source or not state.queue:
+            return
+        state.prewarm_handle = asyncio.get_running_loop().call_at(state.prewarm_due_at, self.start_prewarm, state)
+
+    def start_prewarm(self, state: GuildPlayerState):
+        state.prewarm_handle = asyncio.create_task(self.prewarm_next_track(state))
+
+    async def prewarm_next_track(self, state: GuildPlayerState):
+        next_tracks = state.queue.peek(1)
+        if not next_tracks:
+            state.prewarm_handle = None
+            return
+        next_track = next_tracks[0]
+        try:
+            audio_source, _ = await self.create_audio_source(next_track.result,
+                                                             target_kbps=self.get_target_bitrate_kbps(state))
+        except Exception:
+            self.logger.warning(f"{next_track.search_id}: Failed to pre-warm {next_track.result.watch_url}",
+                                exc_info=True)
+            state.prewarm_handle = None
+            return
+        state.prewarm_handle = None
+        if not state.is_playing or next_track not in state.queue.peek(1):
+            audio_source.cleanup()
+            return
+        self.logger.debug("%s: Pre-warmed audio source", next_track.search_id)
+        state.prewarmed_track = next_track
+        state.prewarmed_source = audio_source
 
     @Cog.listener()
     async def on_message(self, message: Message):
         context = await self.bot.get_context(message)
-        if message.author.bot or message.channel.id != int(os.environ["TEXT_CHANNEL_ID"]):
+        if message.author.bot or not self.is_bot_text_channel(message.channel):
             return
         user_input = message.content
         if user_input.startswith("!"):
             # await self.bot.process_commands(message)
             ...
         elif "list=" in user_input:
-            for video in Playlist(user_input).videos:
-                self.playlist.append(video)
-            if not self.is_playing:
-                await self.play_youtube_audio(context, message.author)
+            ingestion_task = asyncio.create_task(self.queue_playlist(context, message.author, user_input))
+            self.ingestion_tasks.add(ingestion_task)
+            ingestion_task.add_done_callback(self.ingestion_tasks.discard)
 
         else:
             await self.search_yt(context, user_input)
-        await message.delete(delay=5)
+        self.outbound.delete_later(message, 5)
@@ -0,0 +1,87 @@
+import asyncio
+import heapq
+import itertools
+from typing import Any, Callable, Hashable
+
+
+class ExpiryScheduler:
+
+    def __init__(self, ttl: float, max_size: int = 1000, on_expire: Callable[[Hashable, Any], None] | None = None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.on_expire = on_expire
+        self._entries: dict[Hashable, tuple[float, int, Any]] = {}
+        # Min-heap of (deadline, sequence, key). Removed or replaced entries stay in the heap until they reach the
+        # top and are skipped, so removals stay O(1) and a single timer covers every pending entry.
+        self._deadlines: list[tuple[float, int, Hashable]] = []
+        self._sequence = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable):
+        return key in self._entries
+
+    def add(self, key: Hashable, value: Any, ttl: float | None = None):
+        deadline = asyncio.get_running_loop().time() + (self.ttl if ttl is None else ttl)
+        sequence = next(self._sequence)
+        self._entries[key] = (deadline, sequence, value)
+        heapq.heappush(self._deadlines, (deadline, sequence, key))
+        while len(self._entries) > self.max_size:
+            self._pop_earliest()
+        if len(self._deadlines) > 2 * len(self._entries) + 64:
+            self._deadlines = [(deadline, sequence, key) for key, (deadline, sequence, _) in self._entries.items()]
+            heapq.heapify(self._deadlines)
+        self._schedule()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        return default if entry is None else entry[2]
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[2]
+
+    def clear(self):
+        self._entries.clear()
+        self._deadlines.clear()
+        self.close()
+
+    def close(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _expire_entry(self, key: Hashable, sequence: int) -> bool:
+        entry = self._entries.get(key)
+        if entry is None or entry[1] != sequence:
+            return False
+        del self._entries[key]
+        if self.on_expire:
+            self.on_expire(key, entry[2])
+        return True
+
+    def _pop_earliest(self):
+        while self._deadlines:
+            _, sequence, key = heapq.heappop(self._deadlines)
+            if self._expire_entry(key, sequence):
+                return
+
+    def _schedule(self):
+        if not self._deadlines:
+            self.close()
+            return
+        deadline = self._deadlines[0][0]
+        if self._timer and self._timer.when() <= deadline:
+            return
+        self.close()
+        self._timer = asyncio.get_running_loop().call_at(deadline, self._expire)
+
+    def _expire(self):
+        self._timer = None
+        now = asyncio.get_running_loop().time()
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, sequence, key = heapq.heappop(self._deadlines)
+            self._expire_entry(key, sequence)
+        self._schedule()
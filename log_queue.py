@@ -0,0 +1,74 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+
+from metrics import metrics
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler.prepare() formats the message before enqueueing it, which would still do the formatting on the
+    # calling thread. Records are passed through as they are and formatted by the listener's handlers instead.
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class SafeQueueListener(logging.handlers.QueueListener):
+    # Stopping twice (explicitly and again at exit) raises on Python < 3.12.
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+
+
+class RateLimitFilter(logging.Filter):
+    # A token bucket per logger name for records below `exempt_level`, with DEBUG records additionally sampled.
+    # Warnings and errors always pass; dropped records are only counted.
+
+    def __init__(self, rate: float, burst: float, debug_sample_rate: float = 1.0,
+                 exempt_level: int = logging.WARNING):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.debug_sample_rate = debug_sample_rate
+        self.exempt_level = exempt_level
+        self._buckets: dict[str, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.exempt_level:
+            return True
+        if record.levelno <= logging.DEBUG and self.debug_sample_rate < 1 \
+                and random.random() >= self.debug_sample_rate:
+            metrics.increment("log_records_dropped_total", logger=record.name, reason="sampled")
+            return False
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(record.name, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            allowed = tokens >= 1
+            self._buckets[record.name] = (tokens - 1 if allowed else tokens, now)
+        if not allowed:
+            metrics.increment("log_records_dropped_total", logger=record.name, reason="rate_limited")
+        return allowed
+
+
+def start_queue_listener(logger: logging.Logger, *filters: logging.Filter) -> SafeQueueListener:
+    # Moves every handler on the logger behind a queue, so emitting a record is an enqueue and the formatting and
+    # file or console writes happen on the listener thread.
+    log_queue = queue.SimpleQueue()
+    handlers = list(logger.handlers)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    queue_handler = DeferredQueueHandler(log_queue)
+    for record_filter in filters:
+        queue_handler.addFilter(record_filter)
+    logger.addHandler(queue_handler)
+    listener = SafeQueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
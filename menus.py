@@ -0,0 +1,72 @@
+import functools
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+import discord
+from discord import Interaction
+from pytube import YouTube
+
+from data_classes import YoutubeSearchResult
+
+NUMBER_EMOJIS = ["1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟"]
+BUTTONS_PER_ROW = 5
+
+
+@dataclass
+class SearchMenu:
+    requester_id: int
+    search_id: str
+    results: list[YouTube]
+    # Matches from the local history index, listed ahead of the YouTube results so their numbers never change.
+    history_results: list[YoutubeSearchResult] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.history_results) + len(self.results)
+
+
+@dataclass
+class HistoryMenu:
+    entries: list[YoutubeSearchResult]
+    page: int = 1
+    total_pages: int = 1
+    # Where the next page starts, for playback history menus; see database.get_recent_history_items.
+    next_cursor: tuple[float, int] | None = None
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class NumberedChoiceView(discord.ui.View):
+    # One numbered button per menu entry, sent together with the menu message so selecting needs no reactions.
+
+    def __init__(self, choice_count: int, on_select: Callable[[Interaction, int], Awaitable],
+                 requester_id: int | None = None, timeout: float | None = None,
+                 on_next_page: Callable[[Interaction], Awaitable] | None = None):
+        super().__init__(timeout=timeout)
+        self.on_select = on_select
+        self.on_next_page = on_next_page
+        self.requester_id = requester_id
+        for index in range(min(choice_count, len(NUMBER_EMOJIS))):
+            button = discord.ui.Button(emoji=NUMBER_EMOJIS[index], style=discord.ButtonStyle.secondary,
+                                       row=index // BUTTONS_PER_ROW)
+            button.callback = functools.partial(self._select, index)
+            self.add_item(button)
+        if on_next_page:
+            button = discord.ui.Button(label="Next page", emoji="▶️", style=discord.ButtonStyle.primary,
+                                       row=len(NUMBER_EMOJIS) // BUTTONS_PER_ROW)
+            button.callback = self._next_page
+            self.add_item(button)
+
+    async def interaction_check(self, interaction: Interaction) -> bool:
+        if self.requester_id is None or interaction.user.id == self.requester_id:
+            return True
+        await interaction.response.send_message("This menu belongs to someone else.", ephemeral=True)
+        return False
+
+    async def _select(self, index: int, interaction: Interaction):
+        await interaction.response.defer()
+        await self.on_select(interaction, index)
+
+    async def _next_page(self, interaction: Interaction):
+        await interaction.response.defer()
+        await self.on_next_page(interaction)
@@ -0,0 +1,169 @@
+import asyncio
+import bisect
+import contextlib
+import functools
+import logging
+import sys
+import threading
+import time
+import traceback
+from typing import Callable
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+logger = logging.getLogger("discord")
+
+
+class Histogram:
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.histograms: dict[tuple[str, tuple[tuple[str, str], ...]], Histogram] = {}
+        self.counters: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+        # Metrics are also recorded off the event loop (the stall watchdog, logging from executor threads).
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def increment(self, name: str, amount: float = 1, **labels: str):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def time(self, name: str, **labels: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def timed(self, name: str, **labels: str):
+        def decorator(func: Callable):
+            @functools.wraps(func)
+            async def wrapper(*args: tuple, **kwargs: dict):
+                with self.time(name, **labels):
+                    return await func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def render_prometheus(self) -> str:
+        # Only the snapshot is taken under the lock; formatting it does not hold up threads recording metrics.
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = [(key, histogram.buckets, list(histogram.bucket_counts), histogram.count, histogram.sum)
+                          for key, histogram in sorted(self.histograms.items())]
+        lines = []
+        for (name, labels), value in counters:
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        for (name, labels), buckets, bucket_counts, count, total in histograms:
+            cumulative_count = 0
+            for bucket, bucket_count in zip(buckets, bucket_counts):
+                cumulative_count += bucket_count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bucket)),))} {cumulative_count}")
+            lines.append(f"{name}_bucket{_format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+metrics = MetricsRegistry()
+
+
+class LoopStallMonitor:
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.05):
+        self.threshold = threshold
+        self.interval = interval
+        self._last_heartbeat = time.monotonic()
+        self._loop_thread_id: int | None = None
+        self._heartbeat_task: asyncio.Task | None = None
+        self._watchdog_stopped = threading.Event()
+        self._watchdog: threading.Thread | None = None
+
+    def start(self):
+        self._loop_thread_id = threading.get_ident()
+        self._last_heartbeat = time.monotonic()
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        self._watchdog_stopped.clear()
+        self._watchdog = threading.Thread(target=self._watch, name="loop-stall-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+        self._watchdog_stopped.set()
+
+    async def _heartbeat(self):
+        while True:
+            expected_at = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            metrics.observe("event_loop_lag_seconds", max(0.0, now - expected_at))
+            self._last_heartbeat = now
+
+    def _watch(self):
+        # Runs in its own thread so it can still see the loop while the loop is blocked, and captures the loop
+        # thread's stack at that moment to show what is holding it.
+        reported_heartbeat = None
+        while not self._watchdog_stopped.wait(self.threshold / 2):
+            heartbeat = self._last_heartbeat
+            stalled_for = time.monotonic() - heartbeat - self.interval
+            if stalled_for < self.threshold or heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            metrics.increment("event_loop_stalls_total")
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<unavailable>"
+            logger.warning(f"Event loop blocked for more than {stalled_for:.3f}s, loop thread stack:\n{stack}")
+
+
+class MetricsServer:
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 9090):
+        self.host = host
+        self.port = port
+        self._runner: web.AppRunner | None = None
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    @staticmethod
+    async def _handle_metrics(_request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
@@ -0,0 +1,258 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Hashable
+
+import discord
+from discord import Message
+from discord.abc import Messageable
+
+from expiry_scheduler import ExpiryScheduler
+from metrics import metrics
+
+# Discord allows roughly five message creates or edits per channel every five seconds.
+MESSAGES_PER_WINDOW = 5
+RATE_LIMIT_WINDOW = 5.0
+DELETE_BATCH_DELAY = 1.0
+BULK_DELETE_LIMIT = 100
+STATUS_LINE_LIMIT = 15
+MAX_SCHEDULED_DELETES = 10000
+
+logger = logging.getLogger("discord")
+
+
+class Priority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+@dataclass(order=True)
+class OutboundMessage:
+    priority: int
+    sequence: int
+    lines: list[str] = field(compare=False)
+    kwargs: dict[str, Any] = field(compare=False, default_factory=dict)
+    delete_after: float | None = field(compare=False, default=None)
+    expires_at: float | None = field(compare=False, default=None)
+    coalesce_key: Hashable | None = field(compare=False, default=None)
+    edit_target: Message | None = field(compare=False, default=None)
+    future: asyncio.Future | None = field(compare=False, default=None)
+    queued_at: float = field(compare=False, default=0.0)
+
+
+@dataclass
+class StatusMessage:
+    message: Message
+    lines: list[str]
+
+
+class ChannelOutbox:
+
+    def __init__(self, channel: Messageable, scheduler: "OutboundScheduler"):
+        self.channel = channel
+        self.scheduler = scheduler
+        self._pending: list[OutboundMessage] = []
+        # Notices that are queued but not yet sent, and status messages that are still visible, by coalesce key.
+        self._coalescing: dict[Hashable, OutboundMessage] = {}
+        self._status_messages: dict[Hashable, StatusMessage] = {}
+        self._sent_at: deque[float] = deque(maxlen=scheduler.messages_per_window)
+        self._pending_deletes: list[Message] = []
+        self._drain_task: asyncio.Task | None = None
+        self._delete_timer: asyncio.TimerHandle | None = None
+        self._delete_tasks: set[asyncio.Task] = set()
+
+    def enqueue(self, outbound: OutboundMessage):
+        outbound.queued_at = asyncio.get_running_loop().time()
+        heapq.heappush(self._pending, outbound)
+        if outbound.coalesce_key is not None:
+            self._coalescing[outbound.coalesce_key] = outbound
+        if self._drain_task is None:
+            self._drain_task = asyncio.create_task(self._drain())
+
+    def coalesce(self, key: Hashable, content: str, replace: bool, priority: Priority,
+                 delete_after: float | None) -> bool:
+        loop_time = asyncio.get_running_loop().time()
+        outbound = self._coalescing.get(key)
+        if outbound is not None:
+            outbound.lines = [content] if replace else outbound.lines + [content]
+            outbound.delete_after = delete_after
+            outbound.expires_at = None if delete_after is None else loop_time + delete_after
+            if priority < outbound.priority:
+                # Re-queue under the higher priority; the old heap entry is skipped once it is popped.
+                self._coalescing.pop(key)
+                self.enqueue(OutboundMessage(priority, next(self.scheduler.sequence), outbound.lines,
+                                             outbound.kwargs, outbound.delete_after, outbound.expires_at, key,
+                                             outbound.edit_target))
+            metrics.increment("outbound_coalesced_total")
+            return True
+        status = self._status_messages.get(key)
+        if status is None:
+            return False
+        lines = [content] if replace else status.lines + [content]
+        self.enqueue(OutboundMessage(priority, next(self.scheduler.sequence), lines, delete_after=delete_after,
+                                     expires_at=None if delete_after is None else loop_time + delete_after,
+                                     coalesce_key=key, edit_target=status.message))
+        return True
+
+    def forget_status_message(self, message: Message):
+        for key, status in list(self._status_messages.items()):
+            if status.message.id == message.id:
+                del self._status_messages[key]
+
+    def queue_delete(self, message: Message):
+        self.forget_status_message(message)
+        self._pending_deletes.append(message)
+        if self._delete_timer is None:
+            self._delete_timer = asyncio.get_running_loop().call_later(DELETE_BATCH_DELAY, self._start_delete_flush)
+
+    def close(self):
+        if self._drain_task:
+            self._drain_task.cancel()
+        if self._delete_timer:
+            self._delete_timer.cancel()
+        for delete_task in self._delete_tasks:
+            delete_task.cancel()
+        for outbound in self._pending:
+            if outbound.future and not outbound.future.done():
+                outbound.future.cancel()
+
+    async def _wait_for_rate_limit(self):
+        loop = asyncio.get_running_loop()
+        if len(self._sent_at) == self._sent_at.maxlen:
+            wait_time = self._sent_at[0] + self.scheduler.window - loop.time()
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+
+    async def _drain(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self._pending:
+                await self._wait_for_rate_limit()
+                outbound = heapq.heappop(self._pending)
+                if outbound.coalesce_key is not None:
+                    if self._coalescing.get(outbound.coalesce_key) is not outbound:
+                        continue
+                    del self._coalescing[outbound.coalesce_key]
+                metrics.observe("outbound_queue_delay_seconds", loop.time() - outbound.queued_at,
+                                priority=Priority(outbound.priority).name.lower())
+                if outbound.expires_at is not None and loop.time() >= outbound.expires_at:
+                    # It would already have been deleted, so sending it now only costs rate limit budget.
+                    metrics.increment("outbound_dropped_total")
+                    if outbound.future and not outbound.future.done():
+                        outbound.future.set_result(None)
+                    continue
+                self._sent_at.append(loop.time())
+                try:
+                    message = await self._deliver(outbound)
+                except Exception as exception:
+                    logger.error(f"Failed to send message to channel {self.channel.id}: {exception!r}")
+                    if outbound.future and not outbound.future.done():
+                        outbound.future.set_exception(exception)
+                    continue
+                # The caller awaiting it may have been cancelled in the meantime, which leaves the future done.
+                if outbound.future and not outbound.future.done():
+                    outbound.future.set_result(message)
+        finally:
+            self._drain_task = None
+
+    async def _deliver(self, outbound: OutboundMessage) -> Message:
+        content = "\n".join(outbound.lines[-STATUS_LINE_LIMIT:])
+        key = outbound.coalesce_key
+        edit_target = outbound.edit_target
+        if key is not None and edit_target is not None:
+            # A status message that was deleted in the meantime is replaced by a new one.
+            status = self._status_messages.get(key)
+            if status is None or status.message.id != edit_target.id:
+                edit_target = None
+        with metrics.time("discord_send_seconds"):
+            if edit_target is not None:
+                message = edit_target
+                await message.edit(content=content, **outbound.kwargs)
+            else:
+                message = await self.channel.send(content, **outbound.kwargs)
+        if key is not None:
+            self._status_messages[key] = StatusMessage(message, outbound.lines[-STATUS_LINE_LIMIT:])
+        if outbound.delete_after is not None:
+            self.scheduler.delete_later(message, outbound.delete_after)
+        return message
+
+    def _start_delete_flush(self):
+        self._delete_timer = None
+        delete_task = asyncio.create_task(self._flush_deletes())
+        self._delete_tasks.add(delete_task)
+        delete_task.add_done_callback(self._delete_tasks.discard)
+
+    async def _flush_deletes(self):
+        pending_deletes, self._pending_deletes = self._pending_deletes, []
+        for index in range(0, len(pending_deletes), BULK_DELETE_LIMIT):
+            batch = pending_deletes[index:index + BULK_DELETE_LIMIT]
+            try:
+                if len(batch) == 1 or not hasattr(self.channel, "delete_messages"):
+                    for message in batch:
+                        await message.delete()
+                else:
+                    await self.channel.delete_messages(batch)
+            except discord.HTTPException as exception:
+                logger.warning(f"Failed to delete {len(batch)} messages in channel {self.channel.id}: "
+                               f"{exception!r}")
+
+
+class OutboundScheduler:
+    # Routes every message the cog sends through a per-channel outbox. Each outbox sends in priority order within
+    # the channel's rate limit, folds notices sharing a coalesce key into one edited status message, drops notices
+    # that would already have been deleted, and batches deletions into bulk deletes.
+
+    def __init__(self, messages_per_window: int = MESSAGES_PER_WINDOW, window: float = RATE_LIMIT_WINDOW):
+        self.messages_per_window = messages_per_window
+        self.window = window
+        self.sequence = itertools.count()
+        self.outboxes: dict[int, ChannelOutbox] = {}
+        self.scheduled_deletes = ExpiryScheduler(ttl=RATE_LIMIT_WINDOW, max_size=MAX_SCHEDULED_DELETES,
+                                                 on_expire=self._on_delete_due)
+
+    def outbox(self, destination: Messageable) -> ChannelOutbox:
+        channel = getattr(destination, "channel", destination)
+        outbox = self.outboxes.get(channel.id)
+        if outbox is None:
+            outbox = self.outboxes[channel.id] = ChannelOutbox(channel, self)
+        return outbox
+
+    async def send(self, destination: Messageable, content: str, priority: Priority = Priority.NORMAL,
+                   delete_after: float | None = None, **kwargs) -> Message | None:
+        future = asyncio.get_running_loop().create_future()
+        self.outbox(destination).enqueue(OutboundMessage(priority, next(self.sequence), [content], kwargs,
+                                                         delete_after, future=future))
+        return await future
+
+    async def edit(self, message: Message, content: str, priority: Priority = Priority.NORMAL,
+                   **kwargs) -> Message | None:
+        future = asyncio.get_running_loop().create_future()
+        self.outbox(message.channel).enqueue(OutboundMessage(priority, next(self.sequence), [content], kwargs,
+                                                             edit_target=message, future=future))
+        return await future
+
+    def notify(self, destination: Messageable, content: str, priority: Priority = Priority.NORMAL,
+               delete_after: float | None = 5, coalesce_key: Hashable | None = None, replace: bool = False):
+        outbox = self.outbox(destination)
+        if coalesce_key is not None and outbox.coalesce(coalesce_key, content, replace, priority, delete_after):
+            return
+        expires_at = None if delete_after is None else asyncio.get_running_loop().time() + delete_after
+        outbox.enqueue(OutboundMessage(priority, next(self.sequence), [content], delete_after=delete_after,
+                                       expires_at=expires_at, coalesce_key=coalesce_key))
+
+    def delete_later(self, message: Message, delay: float = 0):
+        self.scheduled_deletes.add(message.id, message, ttl=delay)
+
+    def close(self):
+        self.scheduled_deletes.clear()
+        for outbox in self.outboxes.values():
+            outbox.close()
+        self.outboxes.clear()
+
+    def _on_delete_due(self, _message_id: int, message: Message):
+        self.outbox(message.channel).queue_delete(message)
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Iterable
+
+from discord import AudioSource, VoiceClient
+
+from track_queue import Track, TrackQueue
+
+
+@dataclass
+class GuildPlayerState:
+    guild_id: int
+    queue: TrackQueue = field(default_factory=TrackQueue)
+    is_playing: bool = False
+    voice_client: VoiceClient | None = None
+    last_active: float = field(default_factory=time.monotonic)
+    track_started_at: float | None = None
+    track_start_offset: float = 0.0
+    prewarmed_track: Track | None = None
+    prewarmed_source: AudioSource | None = None
+    prewarm_handle: asyncio.TimerHandle | asyncio.Task | None = None
+    prewarm_due_at: float = 0.0
+    # Whether the last persisted player state marked this guild as playing, so stopping is persisted once.
+    playback_saved: bool = False
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def reset(self):
+        self.queue.clear()
+        self.is_playing = False
+        self.track_started_at = None
+        self.discard_prewarmed()
+
+    def discard_prewarmed(self):
+        # Kills the FFmpeg process of a source that was started ahead of time but will not be played.
+        if self.prewarm_handle:
+            self.prewarm_handle.cancel()
+            self.prewarm_handle = None
+        if self.prewarmed_source:
+            self.prewarmed_source.cleanup()
+        self.prewarmed_track = None
+        self.prewarmed_source = None
+
+    def take_prewarmed(self, track: Track) -> AudioSource | None:
+        source = None
+        if self.prewarmed_track is track:
+            source, self.prewarmed_source = self.prewarmed_source, None
+        self.discard_prewarmed()
+        return source
+
+    def start_track(self, start_offset: float = 0.0):
+        self.track_started_at = time.monotonic()
+        self.track_start_offset = start_offset
+
+    @property
+    def playback_offset(self) -> float:
+        if self.track_started_at is None:
+            return 0.0
+        return self.track_start_offset + time.monotonic() - self.track_started_at
+
+    def is_idle(self, idle_timeout: float) -> bool:
+        if self.is_playing or self.queue or (self.voice_client and self.voice_client.is_connected()):
+            return False
+        return time.monotonic() - self.last_active >= idle_timeout
+
+
+class GuildStateManager:
+
+    def __init__(self, idle_timeout: float = 15 * 60):
+        self.idle_timeout = idle_timeout
+        self._states: dict[int, GuildPlayerState] = {}
+
+    def __len__(self):
+        return len(self._states)
+
+    def get(self, guild_id: int) -> GuildPlayerState:
+        state = self._states.get(guild_id)
+        if state is None:
+            state = self._states[guild_id] = GuildPlayerState(guild_id=guild_id)
+        state.touch()
+        return state
+
+    def peek(self, guild_id: int) -> GuildPlayerState | None:
+        return self._states.get(guild_id)
+
+    def values(self) -> Iterable[GuildPlayerState]:
+        return self._states.values()
+
+    def evict_idle(self) -> int:
+        idle_guild_ids = [guild_id for guild_id, state in self._states.items() if state.is_idle(self.idle_timeout)]
+        for guild_id in idle_guild_ids:
+            del self._states[guild_id]
+        return len(idle_guild_ids)
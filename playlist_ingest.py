@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator
+
+from pytube import Playlist, YouTube
+
+from data_classes import YoutubeSearchResult
+
+logger = logging.getLogger("discord")
+
+
+def fetch_track_metadata(watch_url: str) -> tuple[str, str]:
+    youtube = YouTube(watch_url)
+    return youtube.title, youtube.author
+
+
+class PlaylistIngester:
+
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max_workers
+        # One extra thread walks the playlist pages while the others fetch track metadata.
+        self._executor = ThreadPoolExecutor(max_workers=max_workers + 1, thread_name_prefix="playlist-ingest")
+
+    async def ingest(self, playlist_url: str, added_by: str,
+                     added_by_id: int | None = None) -> AsyncIterator[YoutubeSearchResult | None]:
+        # Tracks are yielded in playlist order as soon as each one is resolved; None marks an entry that failed.
+        loop = asyncio.get_running_loop()
+        pending_urls: asyncio.Queue[tuple[int, str] | None] = asyncio.Queue()
+        resolved_tracks: asyncio.Queue[tuple[int, YoutubeSearchResult | None]] = asyncio.Queue()
+        stop_discovery = threading.Event()
+        discovered_count = 0
+
+        def discover_video_urls():
+            nonlocal discovered_count
+            try:
+                for index, watch_url in enumerate(Playlist(playlist_url).video_urls):
+                    if stop_discovery.is_set():
+                        return
+                    loop.call_soon_threadsafe(pending_urls.put_nowait, (index, watch_url))
+                    discovered_count = index + 1
+            except Exception:
+                logger.warning(f"Failed to list playlist {playlist_url}", exc_info=True)
+            finally:
+                for _ in range(self.max_workers):
+                    loop.call_soon_threadsafe(pending_urls.put_nowait, None)
+
+        async def resolve_tracks():
+            while (pending_url := await pending_urls.get()) is not None:
+                index, watch_url = pending_url
+                try:
+                    title, author = await loop.run_in_executor(self._executor, fetch_track_metadata, watch_url)
+                except Exception:
+                    logger.warning(f"Failed to resolve playlist entry {watch_url}", exc_info=True)
+                    await resolved_tracks.put((index, None))
+                    continue
+                await resolved_tracks.put((index, YoutubeSearchResult(
+                    uuid=str(uuid.uuid4()),
+                    added_by=added_by,
+                    uploader_name=author,
+                    title=title,
+                    url=None,
+                    watch_url=watch_url,
+                    added_by_id=added_by_id
+                )))
+
+        discovery = loop.run_in_executor(self._executor, discover_video_urls)
+        workers = [asyncio.create_task(resolve_tracks()) for _ in range(self.max_workers)]
+        out_of_order: dict[int, YoutubeSearchResult | None] = {}
+        next_index = 0
+        try:
+            while True:
+                while next_index in out_of_order:
+                    yield out_of_order.pop(next_index)
+                    next_index += 1
+                running_workers = [worker for worker in workers if not worker.done()]
+                if not running_workers and resolved_tracks.empty():
+                    break
+                get_resolved = asyncio.ensure_future(resolved_tracks.get())
+                await asyncio.wait([get_resolved, *running_workers], return_when=asyncio.FIRST_COMPLETED)
+                if get_resolved.done():
+                    index, track = get_resolved.result()
+                    out_of_order[index] = track
+                else:
+                    get_resolved.cancel()
+            await discovery
+            logger.debug("Ingested %d of %d entries from %s", next_index, discovered_count, playlist_url)
+        finally:
+            stop_discovery.set()
+            for worker in workers:
+                worker.cancel()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,75 @@
+import asyncio
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from pytube import Search, YouTube
+
+SEARCH_RESULT_LIMIT = 3
+
+
+def fetch_top_results(search_input: str) -> list[YouTube]:
+    search = Search(search_input)
+    return [result for result in search.results[0:SEARCH_RESULT_LIMIT] if not result.age_restricted]
+
+
+class SearchCache:
+
+    def __init__(self, max_size: int = 256, ttl: float = 15 * 60, max_workers: int = 8):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, list[YouTube]]] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Future] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="youtube-search")
+
+    @staticmethod
+    def normalize_query(search_input: str) -> str:
+        return " ".join(search_input.casefold().split())
+
+    def get(self, search_input: str) -> list[YouTube] | None:
+        key = self.normalize_query(search_input)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, results = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return results
+
+    def put(self, search_input: str, results: list[YouTube]):
+        key = self.normalize_query(search_input)
+        self._entries[key] = (time.monotonic() + self.ttl, results)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def search(self, search_input: str) -> list[YouTube]:
+        cached_results = self.get(search_input)
+        if cached_results is not None:
+            self.hits += 1
+            return cached_results
+        self.misses += 1
+        key = self.normalize_query(search_input)
+        # Identical queries that arrive while a fetch is running share it instead of hitting YouTube again.
+        in_flight = self._in_flight.get(key)
+        if in_flight is None:
+            loop = asyncio.get_running_loop()
+            in_flight = loop.run_in_executor(self._executor, fetch_top_results, key)
+            self._in_flight[key] = in_flight
+            try:
+                results = await asyncio.shield(in_flight)
+            finally:
+                del self._in_flight[key]
+            self.put(key, results)
+            return results
+        return await asyncio.shield(in_flight)
+
+    def clear(self):
+        self._entries.clear()
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,277 @@
+import asyncio
+import copy
+import logging
+import math
+import multiprocessing
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Iterable
+from urllib.parse import urlparse, parse_qs
+
+import pytube
+from pytube import YouTube, Stream, extract
+from pytube.cipher import Cipher
+from pytube.exceptions import VideoUnavailable
+
+from data_classes import YoutubeSearchResult
+from metrics import metrics
+
+# googlevideo URLs normally carry an `expire` parameter; this is only used when one is missing.
+DEFAULT_STREAM_URL_TTL = 5 * 60 * 60
+# A URL this close to expiry is re-resolved, so a long track never starts on a link that dies mid-playback.
+STREAM_URL_EXPIRY_MARGIN = 10 * 60
+RESOLVE_TIMEOUT = 30
+RESOLVE_ATTEMPTS = 3
+RESOLVE_RETRY_DELAY = 1.0
+MAX_CACHED_CIPHERS = 4
+
+logger = logging.getLogger("discord")
+
+
+@dataclass
+class ResolvedStream:
+    url: str
+    expires_at: float
+    mime_type: str | None = None
+    audio_codec: str | None = None
+    duration: float | None = None
+    bitrate_kbps: int = 0
+    bitrate: int | None = None
+    audio_only: bool = True
+
+    @property
+    def is_opus(self) -> bool:
+        return self.mime_type == "audio/webm" and self.audio_codec == "opus"
+
+
+class StreamResolveError(Exception):
+    # pytube exceptions such as RegexMatchError cannot be unpickled, and one that fails to come back from a worker
+    # process breaks the whole pool. Workers raise these instead, which only carry a message.
+    pass
+
+
+class StreamUnavailableError(StreamResolveError):
+    pass
+
+
+def get_video_id(watch_url: str) -> str:
+    return extract.video_id(watch_url)
+
+
+def get_stream_url_expiry(url: str) -> float:
+    expire = parse_qs(urlparse(url).query).get("expire")
+    if expire and expire[0].isnumeric():
+        return float(expire[0])
+    return time.time() + DEFAULT_STREAM_URL_TTL
+
+
+def get_bitrate_kbps(stream: Stream) -> int:
+    return int(stream.abr.removesuffix("kbps")) if stream.abr else 0
+
+
+# Parsed player JS ciphers by player URL, which changes with every player version; only used in resolver processes.
+_cipher_templates: dict[str, Cipher] = {}
+
+
+def create_cipher(js: str) -> Cipher:
+    # Parsing the player JS into a Cipher is the most expensive part of resolving a stream, and pytube does it for
+    # every video. The parsed cipher is kept per player version and each video gets a copy with its own throttling
+    # state, since calculate_n mutates the throttling array and caches its result on the instance.
+    player_url = pytube.__js_url__ if pytube.__js__ is js else None
+    template = _cipher_templates.get(player_url) if player_url else None
+    if template is None:
+        template = Cipher(js=js)
+        if player_url:
+            if len(_cipher_templates) >= MAX_CACHED_CIPHERS:
+                _cipher_templates.clear()
+            _cipher_templates[player_url] = template
+    cipher = copy.copy(template)
+    cipher.throttling_array = copy.deepcopy(template.throttling_array)
+    cipher.calculated_n = None
+    return cipher
+
+
+def initialize_resolver_process():
+    extract.Cipher = create_cipher
+    # Records logged here have nowhere to go; the parent's queue handler is never drained in a worker.
+    logging.getLogger("discord").handlers.clear()
+
+
+def score_audio_stream(stream: ResolvedStream, target_kbps: int | None) -> tuple:
+    # Opus in WebM can be handed to Discord without re-encoding. Without a target the highest bitrate wins; with one,
+    # the cheapest stream that still fills the channel's bitrate wins, and below it the highest bitrate does.
+    if target_kbps is None:
+        return stream.audio_codec == "opus", stream.bitrate_kbps
+    saturates = stream.bitrate_kbps >= target_kbps
+    return (saturates, stream.audio_codec == "opus", stream.mime_type == "audio/webm",
+            -stream.bitrate_kbps if saturates else stream.bitrate_kbps, -(stream.bitrate or math.inf))
+
+
+def get_best_audio_stream(audio_streams: list[ResolvedStream], target_kbps: int | None = None) -> ResolvedStream:
+    return max(audio_streams, key=lambda stream_: score_audio_stream(stream_, target_kbps))
+
+
+def get_smallest_progressive_stream(progressive_streams: list[ResolvedStream],
+                                    target_kbps: int | None = None) -> ResolvedStream:
+    # FFmpeg drops the video anyway, so the least data that still carries enough audio is the best choice.
+    return max(progressive_streams,
+               key=lambda stream_: (target_kbps is None or stream_.bitrate_kbps >= target_kbps,
+                                    -(stream_.bitrate or math.inf)))
+
+
+def select_stream(candidates: list[ResolvedStream], target_kbps: int | None = None) -> ResolvedStream:
+    if candidates[0].audio_only:
+        return get_best_audio_stream(candidates, target_kbps)
+    return get_smallest_progressive_stream(candidates, target_kbps)
+
+
+def resolve_streams(watch_url: str) -> list[ResolvedStream]:
+    # Returns every candidate rather than one pick, so the same resolution serves channels of any bitrate.
+    youtube = YouTube(watch_url)
+    audio_only_streams = youtube.streams.filter(only_audio=True)
+    if audio_only_streams:
+        logger.debug(f"{watch_url}: Found Audio Only stream, proceeding with it.")
+        streams = audio_only_streams.fmt_streams
+    else:
+        logger.debug(f"{watch_url}: No Audio Only streams found, proceeding with the smallest progressive stream.")
+        streams = youtube.streams.filter(progressive=True).fmt_streams
+    if not streams:
+        raise StreamResolveError(f"{watch_url}: No playable streams")
+    return [ResolvedStream(url=stream.url, expires_at=get_stream_url_expiry(stream.url), mime_type=stream.mime_type,
+                           audio_codec=stream.audio_codec, duration=youtube.length,
+                           bitrate_kbps=get_bitrate_kbps(stream), bitrate=stream.bitrate,
+                           audio_only=bool(audio_only_streams))
+            for stream in streams]
+
+
+def resolve_streams_safely(watch_url: str) -> list[ResolvedStream]:
+    try:
+        return resolve_streams(watch_url)
+    except StreamResolveError:
+        raise
+    except VideoUnavailable as exception:
+        raise StreamUnavailableError(f"{watch_url}: {exception!r}") from None
+    except Exception as exception:
+        raise StreamResolveError(f"{watch_url}: {exception!r}") from None
+
+
+class StreamCache:
+
+    def __init__(self, max_size: int = 512, max_workers: int = 4, use_processes: bool = True,
+                 timeout: float = RESOLVE_TIMEOUT):
+        self.max_size = max_size
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+        self.timeout = timeout
+        # Every candidate stream of a video is kept under its ID, and each lookup picks the one for its target
+        # bitrate, so a track prefetched before the bot joined voice is not resolved again once it has.
+        self._entries: OrderedDict[str, list[ResolvedStream]] = OrderedDict()
+        self._in_flight: dict[str, asyncio.Task] = {}
+        self._waiter_counts: dict[asyncio.Task, int] = {}
+        self._prefetch_tasks: set[asyncio.Task] = set()
+        self._executor = self._create_executor()
+
+    def _create_executor(self) -> Executor:
+        # pytube's page parsing and cipher extraction is pure-Python regex work that holds the GIL, so it runs in
+        # worker processes and only the plain ResolvedStream data comes back.
+        # Workers are started from a clean forkserver (or spawned) rather than forked from the bot, whose threads
+        # could be holding locks and whose logging handlers would be copied into every worker.
+        if self.use_processes:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            return ProcessPoolExecutor(max_workers=self.max_workers, initializer=initialize_resolver_process,
+                                       mp_context=multiprocessing.get_context(start_method))
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="stream-resolver")
+
+    def get(self, watch_url: str, target_kbps: int | None = None) -> ResolvedStream | None:
+        video_id = get_video_id(watch_url)
+        candidates = self._entries.get(video_id)
+        if candidates is None:
+            return None
+        resolved_stream = select_stream(candidates, target_kbps)
+        if resolved_stream.expires_at - STREAM_URL_EXPIRY_MARGIN <= time.time():
+            del self._entries[video_id]
+            return None
+        self._entries.move_to_end(video_id)
+        return resolved_stream
+
+    def put(self, watch_url: str, candidates: list[ResolvedStream]):
+        video_id = get_video_id(watch_url)
+        self._entries[video_id] = candidates
+        self._entries.move_to_end(video_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def resolve(self, watch_url: str, target_kbps: int | None = None) -> ResolvedStream:
+        cached_stream = self.get(watch_url, target_kbps)
+        if cached_stream is not None:
+            return cached_stream
+        video_id = get_video_id(watch_url)
+        in_flight = self._in_flight.get(video_id)
+        if in_flight is None:
+            in_flight = self._in_flight[video_id] = asyncio.create_task(self._resolve(watch_url, video_id))
+            self._waiter_counts[in_flight] = 0
+        # Callers share one resolution; it is only cancelled once every caller waiting on it has gone away.
+        self._waiter_counts[in_flight] += 1
+        try:
+            return select_stream(await asyncio.shield(in_flight), target_kbps)
+        finally:
+            self._waiter_counts[in_flight] -= 1
+            if not self._waiter_counts[in_flight]:
+                del self._waiter_counts[in_flight]
+                if not in_flight.done():
+                    # Drop it right away so a new caller starts a fresh resolution instead of joining this one.
+                    self._in_flight.pop(video_id, None)
+                    in_flight.cancel()
+
+    async def _resolve(self, watch_url: str, video_id: str) -> list[ResolvedStream]:
+        loop = asyncio.get_running_loop()
+        try:
+            with metrics.time("stream_resolve_seconds"):
+                for attempt in range(1, RESOLVE_ATTEMPTS + 1):
+                    # On timeout or cancellation a request still waiting for a worker is dropped; one that already
+                    # started runs to completion in its process and its result is discarded.
+                    executor = self._executor
+                    try:
+                        future = loop.run_in_executor(executor, resolve_streams_safely, watch_url)
+                        candidates = await asyncio.wait_for(future, self.timeout)
+                        break
+                    except StreamUnavailableError:
+                        raise
+                    except Exception as exception:
+                        # Only the first caller to see the pool break replaces it; later ones would otherwise shut
+                        # down the replacement along with other guilds' work queued on it.
+                        if isinstance(exception, BrokenProcessPool) and executor is self._executor:
+                            executor.shutdown(wait=False, cancel_futures=True)
+                            self._executor = self._create_executor()
+                        if attempt == RESOLVE_ATTEMPTS:
+                            raise
+                        metrics.increment("stream_resolve_retries_total")
+                        logger.warning(f"{watch_url}: Resolve attempt {attempt} failed with {exception!r}, retrying")
+                        await asyncio.sleep(RESOLVE_RETRY_DELAY * attempt)
+            self.put(watch_url, candidates)
+            return candidates
+        finally:
+            if self._in_flight.get(video_id) is asyncio.current_task():
+                del self._in_flight[video_id]
+
+    def prefetch(self, items: Iterable[YoutubeSearchResult]):
+        for item in items:
+            if self.get(item.watch_url) is not None or get_video_id(item.watch_url) in self._in_flight:
+                continue
+            task = asyncio.create_task(self._prefetch(item))
+            self._prefetch_tasks.add(task)
+            task.add_done_callback(self._prefetch_tasks.discard)
+
+    async def _prefetch(self, item: YoutubeSearchResult):
+        try:
+            await self.resolve(item.watch_url)
+        except Exception:
+            logger.warning(f"{item.uuid}: Failed to prefetch stream for {item.watch_url}", exc_info=True)
+
+    def close(self):
+        for task in self._prefetch_tasks:
+            task.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
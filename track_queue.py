@@ -0,0 +1,87 @@
+import itertools
+from collections import deque
+from dataclasses import dataclass
+from typing import Iterator
+
+from data_classes import YoutubeSearchResult
+
+
+@dataclass(slots=True)
+class Track:
+    result: YoutubeSearchResult
+    position: int = 0
+
+    @property
+    def search_id(self) -> str:
+        return self.result.uuid
+
+
+class TrackQueue:
+
+    def __init__(self):
+        self.current: Track | None = None
+        # Played tracks are dropped as soon as they are popped, so a long session only holds what is still upcoming.
+        self._upcoming: deque[Track] = deque()
+        # Positions order the persisted rows.
+        self._next_position = 0
+        # Rows to write since the last take_changes(), by position; None marks a row to delete.
+        self._changes: dict[int, Track | None] = {}
+        self._cleared = False
+
+    def __len__(self):
+        return len(self._upcoming)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self) -> Iterator[Track]:
+        return iter(self._upcoming)
+
+    def append(self, result: YoutubeSearchResult) -> Track:
+        track = Track(result, self._next_position)
+        self._next_position += 1
+        self._upcoming.append(track)
+        self._changes[track.position] = track
+        return track
+
+    def restore(self, tracks: list[Track]):
+        # Loads tracks that are already persisted, so they are not recorded as changes.
+        self._upcoming.extend(tracks)
+        if tracks:
+            self._next_position = max(self._next_position, max(track.position for track in tracks) + 1)
+
+    def take_changes(self) -> tuple[bool, dict[int, Track | None]]:
+        changes, cleared = self._changes, self._cleared
+        self._changes, self._cleared = {}, False
+        return cleared, changes
+
+    def return_changes(self, cleared: bool, changes: dict[int, Track | None]):
+        # Puts back changes whose write failed. Anything recorded since take_changes() is newer and wins, and a clear
+        # since then makes the returned changes moot.
+        if self._cleared:
+            return
+        self._cleared = cleared
+        self._changes = {**changes, **self._changes}
+
+    def peek(self, count: int = 1) -> list[Track]:
+        return list(itertools.islice(self._upcoming, count))
+
+    def advance(self) -> Track | None:
+        if self.current is not None:
+            self._changes[self.current.position] = None
+        self.current = self._upcoming.popleft() if self._upcoming else None
+        return self.current
+
+    def skip(self, count: int) -> int:
+        # O(count): every skipped track is its own row to delete from the persisted queue.
+        skipped = 0
+        while skipped < count and self._upcoming:
+            self._changes[self._upcoming.popleft().position] = None
+            skipped += 1
+        return skipped
+
+    def clear(self):
+        self.current = None
+        self._upcoming.clear()
+        self._changes.clear()
+        self._cleared = True
@@ -0,0 +1,64 @@
+from typing import Callable
+
+from discord import Member, VoiceChannel, VoiceState
+
+from expiry_scheduler import ExpiryScheduler
+
+
+class VoicePresenceTracker:
+    # Keeps a count of human members for each voice channel the bot is connected to, updated from voice state
+    # events, so an event only costs two dict lookups. Channels the bot is in start their grace timer when the
+    # count drops to zero; if nobody has rejoined by the time it expires, on_empty is called with the channel.
+
+    def __init__(self, grace_period: float, on_empty: Callable[[VoiceChannel], None]):
+        self.grace_period = grace_period
+        self.on_empty = on_empty
+        self._human_counts: dict[int, int] = {}
+        self._guild_channel_ids: dict[int, int] = {}
+        self._empty_channels = ExpiryScheduler(ttl=grace_period, max_size=10000,
+                                               on_expire=lambda _channel_id, channel: self.on_empty(channel))
+
+    def __contains__(self, channel_id: int):
+        return channel_id in self._human_counts
+
+    def human_count(self, channel_id: int) -> int | None:
+        return self._human_counts.get(channel_id)
+
+    def track(self, channel: VoiceChannel):
+        self.untrack(channel.guild.id)
+        self._guild_channel_ids[channel.guild.id] = channel.id
+        self._human_counts[channel.id] = sum(1 for member in channel.members if not member.bot)
+        if not self._human_counts[channel.id]:
+            self._empty_channels.add(channel.id, channel)
+
+    def untrack(self, guild_id: int):
+        channel_id = self._guild_channel_ids.pop(guild_id, None)
+        if channel_id is not None:
+            del self._human_counts[channel_id]
+            self._empty_channels.pop(channel_id)
+
+    def update(self, member: Member, before: VoiceState, after: VoiceState):
+        before_channel, after_channel = before.channel, after.channel
+        if before_channel is after_channel or (before_channel and after_channel
+                                               and before_channel.id == after_channel.id):
+            return
+        if member.id == member.guild.me.id:
+            if after_channel is None:
+                self.untrack(member.guild.id)
+            else:
+                self.track(after_channel)
+            return
+        if member.bot:
+            return
+        if before_channel is not None and before_channel.id in self._human_counts:
+            self._human_counts[before_channel.id] -= 1
+            if not self._human_counts[before_channel.id]:
+                self._empty_channels.add(before_channel.id, before_channel)
+        if after_channel is not None and after_channel.id in self._human_counts:
+            self._human_counts[after_channel.id] += 1
+            self._empty_channels.pop(after_channel.id)
+
+    def close(self):
+        self._empty_channels.clear()
+        self._human_counts.clear()
+        self._guild_channel_ids.clear()
@@ -1,20 +1,34 @@
 import asyncio
 import logging
+from logging.config import dictConfig
 
 from discord import Intents
-from discord.ext.commands import Bot
+from discord.ext.commands import AutoShardedBot
 
 import config
 from discord_bot import YouTubePlayer, setup_logger
 
-setup_logger()
-
 logger = logging.getLogger('discord')
 
-if __name__ == '__main__':
-    logger.info("Starting execution")
+
+async def main():
     intents = Intents.default()
     intents.message_content = True
-    bot = Bot(command_prefix="!", intents=intents)
-    asyncio.run(bot.add_cog(YouTubePlayer(bot)))
-    bot.run(config.DISCORD_API_KEY, log_handler=None)
+    bot = AutoShardedBot(command_prefix="!", intents=intents)
+    # The cog starts background tasks in cog_load, so it has to be added on the loop the bot runs on.
+    async with bot:
+        await bot.add_cog(YouTubePlayer(bot))
+        await bot.start(config.DISCORD_API_KEY)
+
+
+if __name__ == '__main__':
+    # Resolver worker processes import this module as well, so logging is only set up here: they must not truncate
+    # the log files or start listeners of their own.
+    dictConfig(config.LOGGING_CONFIG)
+    log_listener = setup_logger()
+    logger.info("Starting execution")
+    try:
+        asyncio.run(main())
+    finally:
+        # Flushes the records still queued, instead of leaving that to the atexit hook.
+        log_listener.stop()